@@ -0,0 +1,127 @@
+"""CPU cost per record of decoding CRM pages and encoding MoEngage bodies, per JSON codec.
+
+Builds one OData page per entity with the Dynamics stand-in, using each entity's real
+``$select``/``$expand``, then times every installed codec (see ``sourcecode.jsonCodec``)
+on the steps a sync runs for every record::
+
+    python -m benchmarks.codec_throughput
+    python -m benchmarks.codec_throughput --records 5000 --repeat 20 --json
+
+``decode`` is the untyped page decode, ``decode_fields`` the decode restricted to the
+mapping's columns (only narrower with msgspec), ``encode`` the per-customer size
+measurement plus the batched request bodies. ``json_stdlib`` is the previous behaviour
+(``response.json()`` and ``json.dumps`` with default settings) for reference.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+from benchmarks.standins import DynamicsStandIn
+from benchmarks.sync_throughput import BENCH_SETTINGS, ENTITIES
+from sourcecode.jsonCodec import _CODECS
+from sourcecode.moengagePush import transition_payload
+
+
+def _mapping(entity: str):
+    # The routers pull in FastAPI, so they are only imported when a page is built
+    from sourcecode.routers import Accounts, contacts, leads
+
+    return {"leads": leads.LEAD_MAPPING, "contacts": contacts.CONTACT_MAPPING, "accounts": Accounts.ACCOUNT_MAPPING}[entity]
+
+
+def _page_content(entity: str, records: int, mapping):
+    dynamics = DynamicsStandIn(records={entity: records}, page_size=records)
+    url = httpx.URL(f"{BENCH_SETTINGS['CRM_API_URL']}/api/data/v9.0/{entity}",
+                    params={"$select": mapping.select, "$expand": mapping.expand})
+    response = asyncio.run(dynamics.handle(httpx.Request("GET", url)))
+    return response.read()
+
+
+def _best_of(repeat: int, step):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        step()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _encode(dumps, payloads):
+    # push_records sizes every customer, then each batch body is encoded once
+    for payload in payloads:
+        dumps(payload["elements"])
+    dumps(transition_payload(payloads))
+
+
+def _stdlib_baseline(content: bytes, mapping, repeat: int):
+    payloads = mapping.map_page(json.loads(content)["value"])
+    return {
+        "decode": _best_of(repeat, lambda: json.loads(content)),
+        "decode_fields": None,
+        "encode": _best_of(repeat, lambda: _encode(json.dumps, payloads)),
+    }
+
+
+def _codec_timings(codec, content: bytes, mapping, repeat: int):
+    decode_fields = codec.page_decoder(mapping.columns)
+    payloads = mapping.map_page(codec.loads(content)["value"])
+    return {
+        "decode": _best_of(repeat, lambda: codec.loads(content)),
+        "decode_fields": _best_of(repeat, lambda: decode_fields(content)),
+        "encode": _best_of(repeat, lambda: _encode(codec.dumps, payloads)),
+    }
+
+
+def run(entities, records: int, repeat: int):
+    codecs = []
+    for name, codec_class in _CODECS.items():
+        try:
+            codecs.append(codec_class())
+        except ImportError:
+            print(f"{name} is not installed, skipping")
+
+    results = []
+    for entity in entities:
+        mapping = _mapping(entity)
+        content = _page_content(entity, records, mapping)
+        timings = {"json_stdlib": _stdlib_baseline(content, mapping, repeat)}
+        timings.update({codec.name: _codec_timings(codec, content, mapping, repeat) for codec in codecs})
+        for codec, steps in timings.items():
+            row = {"entity": entity, "codec": codec, "records": records, "page_bytes": len(content)}
+            row.update({
+                f"{step}_us_per_record": round(seconds / records * 1_000_000, 3) if seconds is not None else None
+                for step, seconds in steps.items()
+            })
+            results.append(row)
+    return results
+
+
+def _print_table(results):
+    header = f"{'entity':<10}{'codec':<13}{'decode us/rec':>15}{'fields us/rec':>15}{'encode us/rec':>15}"
+    print(header)
+    print("-" * len(header))
+    for row in results:
+        cells = [row[f"{step}_us_per_record"] for step in ("decode", "decode_fields", "encode")]
+        print(f"{row['entity']:<10}{row['codec']:<13}" + "".join(f"{cell:>15.3f}" if cell is not None else f"{'-':>15}" for cell in cells))
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entities", type=lambda value: value.split(","), default=list(ENTITIES),
+                        help="comma-separated subset of leads,contacts,accounts")
+    parser.add_argument("--records", type=int, default=5000, help="records per page (default: 5000, the Dynamics maximum)")
+    parser.add_argument("--repeat", type=int, default=10, help="runs per step; the fastest is reported")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    results = run(args.entities, args.records, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        _print_table(results)
@@ -0,0 +1,336 @@
+import asyncio
+import json
+import random
+import re
+import sys
+import types
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta
+from urllib.parse import unquote
+
+import httpx
+
+
+# Dynamics returns at most this many records per page unless odata.maxpagesize asks for fewer
+DEFAULT_PAGE_SIZE = 5000
+
+# Synthetic records are created one second apart from this moment
+BASE_TIME = datetime(2024, 1, 1)
+
+# Option set attributes and how many options each one has
+OPTION_SET_SIZES = {"new_leadtype": 6, "statuscode": 4, "leadsourcecode": 10, "preferredcontactmethodcode": 5}
+
+_EXPAND_PATTERN = re.compile(r"(\w+)\(\$select=([\w,]+)\)")
+_EQ_PATTERN = re.compile(r"(\w+) eq ([\w-]+)")
+_ATTRIBUTE_PATTERN = re.compile(r"Attributes\(LogicalName='(\w+)'\)")
+_MAX_PAGE_SIZE_PATTERN = re.compile(r"odata\.maxpagesize=(\d+)")
+
+
+def record_id(entity: str, index: int):
+    """Deterministic GUID for the ``index``-th synthetic record of an entity."""
+    return f"{zlib.crc32(entity.encode()):08x}-0000-4000-8000-{index:012d}"
+
+
+def _timestamp(index: int):
+    return (BASE_TIME + timedelta(seconds=index)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _field_value(entity: str, field: str, index: int, owners: int):
+    """Plausible value for one selected column of a synthetic record."""
+    if field in ("createdon", "modifiedon"):
+        return _timestamp(index)
+    if field == "emailaddress1":
+        return f"{entity}{index}@bench.example"
+    if field == "_ownerid_value":
+        return record_id("systemuser", index % owners)
+    if field.startswith("_") and field.endswith("_value"):
+        return record_id(field, index % 1000)
+    if field in OPTION_SET_SIZES:
+        return index % OPTION_SET_SIZES[field] + 1
+    if field.startswith("donot"):
+        return index % 2 == 0
+    return f"{field}-{index}"
+
+
+class _Fault:
+    """Shared latency and error injection for the stand-ins."""
+
+    def __init__(self, latency: float, error_rate: float, seed: int):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    async def delay(self):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+    def should_fail(self):
+        return self.error_rate > 0 and self.random.random() < self.error_rate
+
+
+class DynamicsStandIn:
+    """In-process stand-in for the Dynamics Web API and its token endpoint.
+
+    Serves ``leads``, ``contacts`` and ``accounts`` collections of configurable size with
+    ``@odata.nextLink`` paging, honours ``$select``/``$expand``, answers ``eq`` filters
+    (``systemusers`` and lookup queries), option set metadata under ``EntityDefinitions``
+    and change tracking delta links. ``requests`` counts calls by kind.
+    """
+
+    def __init__(self, records: dict = None, page_size: int = DEFAULT_PAGE_SIZE, owners: int = 200,
+                 latency: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.records = dict(records or {})
+        self.page_size = page_size
+        self.owners = owners
+        self.fault = _Fault(latency, error_rate, seed)
+        self.requests = Counter()
+
+    def transport(self):
+        return httpx.MockTransport(self.handle)
+
+    async def handle(self, request: httpx.Request):
+        await self.fault.delay()
+        if self.fault.should_fail():
+            self.requests["error"] += 1
+            return httpx.Response(503, headers={"Retry-After": "0"}, json={"error": {"message": "Service unavailable (injected)"}})
+
+        path = unquote(request.url.path)
+        if request.method == "POST" and path.endswith("/$batch"):
+            self.requests["batch"] += 1
+            return self._batch(request)
+        return self._route(request)
+
+    def _route(self, request: httpx.Request, counter_prefix: str = ""):
+        path = unquote(request.url.path)
+        if request.method == "POST" and path.endswith("/token"):
+            self.requests[f"{counter_prefix}token"] += 1
+            return httpx.Response(200, json={"token_type": "Bearer", "access_token": "bench-token", "expires_in": "3599"})
+
+        if "EntityDefinitions" in path:
+            self.requests[f"{counter_prefix}metadata"] += 1
+            return self._metadata(path)
+
+        entity = path.rstrip("/").rsplit("/", 1)[-1]
+        params = request.url.params
+        lookups = _EQ_PATTERN.findall(params.get("$filter", ""))
+        if lookups:
+            self.requests[f"{counter_prefix}lookup"] += 1
+            return self._lookup(entity, lookups, params)
+
+        if entity not in self.records:
+            self.requests[f"{counter_prefix}not_found"] += 1
+            return httpx.Response(404, json={"error": {"message": f"Unknown entity set '{entity}'"}})
+
+        self.requests[f"{counter_prefix}page"] += 1
+        return self._page(request, entity, params)
+
+    def _batch(self, request: httpx.Request):
+        """Answer a multipart $batch of GETs; parts are counted as ``batched_<kind>``."""
+        boundary = request.headers["Content-Type"].split("boundary=", 1)[1]
+        text = request.content.decode("utf-8").replace("\r\n", "\n")
+        parts = []
+        for part in text.split(f"--{boundary}")[1:]:
+            if part.startswith("--"):
+                break
+            _, _, message = part.lstrip("\n").partition("\n\n")
+            head, _, _ = message.partition("\n\n")
+            request_line, *header_lines = head.split("\n")
+            method, url, _ = request_line.split(" ")
+            headers = [tuple(item.strip() for item in line.split(":", 1)) for line in header_lines if ":" in line]
+            response = self._route(httpx.Request(method, url, headers=headers), counter_prefix="batched_")
+            parts += [
+                "--batchresponse_bench",
+                "Content-Type: application/http",
+                "Content-Transfer-Encoding: binary",
+                "",
+                f"HTTP/1.1 {response.status_code} {response.reason_phrase}",
+                "Content-Type: application/json; odata.metadata=minimal",
+                "",
+                response.content.decode("utf-8"),
+            ]
+        parts.append("--batchresponse_bench--")
+        return httpx.Response(
+            200,
+            headers={"Content-Type": "multipart/mixed; boundary=batchresponse_bench"},
+            content=("\r\n".join(parts) + "\r\n").encode("utf-8"),
+        )
+
+    def _metadata(self, path: str):
+        match = _ATTRIBUTE_PATTERN.search(path)
+        attribute = match.group(1) if match else "unknown"
+        options = [
+            {"Value": value, "Label": {"UserLocalizedLabel": {"Label": f"{attribute} option {value}"}}}
+            for value in range(1, OPTION_SET_SIZES.get(attribute, 3) + 1)
+        ]
+        return httpx.Response(200, json={
+            "LogicalName": attribute,
+            "DisplayName": {"UserLocalizedLabel": {"Label": attribute}},
+            "OptionSet": {"Options": options},
+        })
+
+    def _lookup(self, entity: str, lookups, params):
+        select = params.get("$select", "").split(",")
+        rows = []
+        for key, value in lookups:
+            index = int(value.rsplit("-", 1)[-1])
+            row = {field: _field_value(entity, field, index, self.owners) for field in select if field}
+            row[key] = value
+            if entity == "systemusers":
+                row["internalemailaddress"] = f"owner{index}@bench.example"
+            rows.append(row)
+        return httpx.Response(200, json={"value": rows})
+
+    def _page(self, request: httpx.Request, entity: str, params):
+        if "$deltatoken" in params:
+            # Nothing changed since the last tracked read
+            return httpx.Response(200, json={"value": [], "@odata.deltaLink": str(request.url)})
+
+        prefer = request.headers.get("Prefer", "")
+        match = _MAX_PAGE_SIZE_PATTERN.search(prefer)
+        page_size = int(match.group(1)) if match else self.page_size
+        start = int(params.get("$skiptoken", "0"))
+        end = min(start + page_size, self.records[entity])
+
+        select = [field for field in params.get("$select", "").split(",") if field]
+        expands = _EXPAND_PATTERN.findall(params.get("$expand", ""))
+        rows = []
+        for index in range(start, end):
+            # Dataverse annotates every record with its row version
+            row = {"@odata.etag": f'W/"{1000000 + index}"', f"{entity[:-1]}id": record_id(entity, index)}
+            for field in select:
+                row[field] = _field_value(entity, field, index, self.owners)
+            for navigation, columns in expands:
+                # Every fourth record has no related record, like an empty lookup
+                if index % 4 == 0:
+                    row[navigation] = None
+                    continue
+                related = row.get(navigation) or {}
+                related.update({column: _field_value(navigation, column, index, self.owners) for column in columns.split(",")})
+                row[navigation] = related
+            rows.append(row)
+
+        body = {"value": rows}
+        if end < self.records[entity]:
+            body["@odata.nextLink"] = str(request.url.copy_set_param("$skiptoken", str(end)))
+        elif "odata.track-changes" in prefer:
+            body["@odata.deltaLink"] = str(request.url.copy_remove_param("$skiptoken").copy_set_param("$deltatoken", "bench"))
+        return httpx.Response(200, json=body)
+
+
+class MoEngageStandIn:
+    """In-process stand-in for the MoEngage transition endpoint; counts posts and customers."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = 1):
+        self.fault = _Fault(latency, error_rate, seed)
+        self.requests = Counter()
+
+    def transport(self):
+        return httpx.MockTransport(self.handle)
+
+    async def handle(self, request: httpx.Request):
+        await self.fault.delay()
+        if self.fault.should_fail():
+            self.requests["error"] += 1
+            return httpx.Response(500, json={"status": "fail", "error": {"message": "Internal error (injected)"}})
+
+        payload = json.loads(request.content or b"{}")
+        self.requests["post"] += 1
+        self.requests["customers"] += sum(1 for element in payload.get("elements", []) if element.get("type") == "customer")
+        return httpx.Response(200, json={"status": "success"})
+
+
+class FakeS3:
+    """Dict-backed ``put_object``/``get_object`` with the boto3 ``NoSuchKey`` error."""
+
+    class _NoSuchKey(Exception):
+        pass
+
+    def __init__(self):
+        self.objects = {}
+        self.exceptions = types.SimpleNamespace(NoSuchKey=self._NoSuchKey)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body.encode("utf-8") if isinstance(Body, str) else Body
+        return {}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self._NoSuchKey(Key)
+        data = self.objects[(Bucket, Key)]
+        return {"Body": types.SimpleNamespace(read=lambda: data)}
+
+
+class FakeSecretsManager:
+    """Returns ``settings`` as the secret string for every secret id."""
+
+    def __init__(self, settings: dict):
+        self.settings = settings
+
+    def get_secret_value(self, SecretId):
+        return {"Name": SecretId, "SecretString": json.dumps(self.settings)}
+
+
+class FakeDynamoDB:
+    """Dict-backed ``put_item``/``get_item``/``delete_item`` for the run lock's conditional writes.
+
+    Understands the two conditions ``runLock.DynamoDbRunLock`` uses: "no item or expired" on
+    put and "owned by" on delete; anything else is applied unconditionally.
+    """
+
+    class _ConditionalCheckFailed(Exception):
+        pass
+
+    def __init__(self):
+        self.items = {}
+        self.exceptions = types.SimpleNamespace(ConditionalCheckFailedException=self._ConditionalCheckFailed)
+
+    @staticmethod
+    def _key(TableName, Key):
+        return TableName, tuple(sorted((name, value["S"]) for name, value in Key.items()))
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeValues=None, **kwargs):
+        key = self._key(TableName, {"entity": Item["entity"]})
+        existing = self.items.get(key)
+        if ConditionExpression and existing is not None:
+            now = float(ExpressionAttributeValues[":now"]["N"])
+            if float(existing["expires_at"]["N"]) >= now:
+                raise self._ConditionalCheckFailed(ConditionExpression)
+        self.items[key] = Item
+        return {}
+
+    def get_item(self, TableName, Key, **kwargs):
+        item = self.items.get(self._key(TableName, Key))
+        return {"Item": item} if item is not None else {}
+
+    def delete_item(self, TableName, Key, ConditionExpression=None, ExpressionAttributeValues=None, **kwargs):
+        key = self._key(TableName, Key)
+        existing = self.items.get(key)
+        if ConditionExpression and (existing is None or existing["owner"] != ExpressionAttributeValues[":owner"]):
+            raise self._ConditionalCheckFailed(ConditionExpression)
+        self.items.pop(key, None)
+        return {}
+
+
+def install_fake_aws(settings: dict):
+    """Register boto3/botocore stand-ins in ``sys.modules`` so no AWS call leaves the process.
+
+    The app imports boto3 lazily, so this must run before the first secrets, checkpoint or
+    log write. Returns ``(s3, secretsmanager)``; DynamoDB (for ``RUN_LOCK_BACKEND=dynamodb``)
+    is served by a ``FakeDynamoDB``.
+    """
+    s3 = FakeS3()
+    secrets = FakeSecretsManager(settings)
+    clients = {"s3": s3, "secretsmanager": secrets, "dynamodb": FakeDynamoDB()}
+
+    boto3 = types.ModuleType("boto3")
+    boto3.client = lambda service, **kwargs: clients[service]
+    botocore = types.ModuleType("botocore")
+    botocore_config = types.ModuleType("botocore.config")
+    botocore_config.Config = lambda **kwargs: kwargs
+    botocore.config = botocore_config
+
+    sys.modules["boto3"] = boto3
+    sys.modules["botocore"] = botocore
+    sys.modules["botocore.config"] = botocore_config
+    return s3, secrets
@@ -0,0 +1,190 @@
+"""End-to-end sync throughput benchmark against local stand-ins.
+
+Runs ``sync_leads``, ``sync_contacts`` and ``sync_accounts`` with Dynamics, MoEngage,
+Secrets Manager and S3 replaced by in-process stand-ins, so nothing leaves the machine.
+For every entity and window size it reports records/s, upstream requests per record and
+peak traced memory::
+
+    python -m benchmarks.sync_throughput
+    python -m benchmarks.sync_throughput --sizes 1000 --entities leads --crm-latency 0.05 --moengage-latency 0.08
+    python -m benchmarks.sync_throughput --crm-error-rate 0.01 --moengage-error-rate 0.02 --json
+
+Every run starts cold: settings, token, option sets, owner index, fingerprints and
+checkpoints are reset, as on a fresh Lambda container. Peak memory comes from tracemalloc,
+which slows Python allocation noticeably; pass ``--no-memory`` for throughput-only runs.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.standins import DynamicsStandIn, MoEngageStandIn, install_fake_aws
+
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+ENTITIES = ("leads", "contacts", "accounts")
+
+BENCH_SETTINGS = {
+    "CRM_API_URL": "https://crm.bench.local",
+    "CRM_TOKEN_URL": "https://login.bench.local/tenant/oauth2/token",
+    "CRM_CLIENT_ID": "bench-client",
+    "CRM_CLIENT_SECRET": "bench-secret",
+    "MOENGAGE_API_URL": "https://api.moengage.bench.local/v1/transition/BENCH",
+    "moe_token": "YmVuY2g6YmVuY2g=",
+}
+
+
+def _configure_environment(workdir: str):
+    """Point every local store at ``workdir`` and every AWS store at the fakes.
+
+    The app reads these settings at import time, so this runs before ``sourcecode`` is imported.
+    """
+    os.environ["CONFIG_BACKEND"] = "secretsmanager"
+    os.environ["CHECKPOINT_S3_BUCKET"] = "bench-checkpoints"
+    os.environ["CHECKPOINT_DB_PATH"] = os.path.join(workdir, "checkpoints.sqlite")
+    os.environ["FINGERPRINT_DB_PATH"] = os.path.join(workdir, "fingerprints.sqlite")
+    os.environ.pop("LOG_DIR", None)
+
+
+def _reset_state(s3):
+    """Drop every cache a warm container would carry over between invocations."""
+    from sourcecode import appConfig, crmAuthentication, fingerprintStore, optionSetCache, ownerIndex
+
+    appConfig._config.update({"values": None, "next_refresh_at": 0.0, "refreshing": False})
+    crmAuthentication.invalidate_crm_token()
+    optionSetCache._option_sets.clear()
+    optionSetCache._snapshot_loaded = False
+    ownerIndex._owner_emails.clear()
+    s3.objects.clear()
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(fingerprintStore.FINGERPRINT_DB_PATH)
+
+
+def _sync_function(entity: str, mode: str):
+    from sourcecode.routers import Accounts, contacts, leads
+
+    # Called directly, not through FastAPI, so Query defaults must be passed explicitly
+    if entity == "leads":
+        return lambda: leads.sync_leads(shards=1)
+    sync = contacts.sync_contacts if entity == "contacts" else Accounts.sync_accounts
+    return lambda: sync(mode=mode, shards=1)
+
+
+async def run_scenario(entity: str, size: int, dynamics: DynamicsStandIn, moengage: MoEngageStandIn, s3,
+                       mode: str = "window", measure_memory: bool = True, verbose: bool = False):
+    """Run one cold sync of ``size`` records and return its measurements."""
+    from sourcecode.logSink import flush
+
+    _reset_state(s3)
+    dynamics.records[entity] = size
+    dynamics.requests.clear()
+    moengage.requests.clear()
+    sync = _sync_function(entity, mode)
+
+    if measure_memory:
+        tracemalloc.start()
+    error = None
+    result = {}
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, (contextlib.nullcontext() if verbose else contextlib.redirect_stdout(devnull)):
+        try:
+            result = await sync()
+        except Exception as e:
+            error = getattr(e, "detail", None) or str(e)
+        elapsed = time.perf_counter() - started
+        await flush()
+    peak = None
+    if measure_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    # Requests inside a $batch share its round trip and are counted separately as batched_*
+    crm_requests = sum(count for kind, count in dynamics.requests.items() if not kind.startswith("batched_"))
+    moengage_requests = moengage.requests["post"] + moengage.requests["error"]
+    return {
+        "entity": entity,
+        "mode": mode if entity != "leads" else "window",
+        "records": size,
+        "seconds": round(elapsed, 3),
+        "records_per_second": round(size / elapsed, 1) if elapsed else None,
+        "success": result.get("success"),
+        "failed": result.get("failed"),
+        "skipped": result.get("skipped"),
+        "crm_requests": dict(dynamics.requests),
+        "moengage_requests": moengage_requests,
+        "crm_requests_per_record": round(crm_requests / size, 4) if size else None,
+        "moengage_requests_per_record": round(moengage_requests / size, 4) if size else None,
+        "peak_memory_mb": round(peak / 1_000_000, 1) if peak is not None else None,
+        "error": error,
+    }
+
+
+def _print_table(results):
+    header = f"{'entity':<9}{'records':>9}{'seconds':>10}{'rec/s':>11}{'crm req/rec':>13}{'moe req/rec':>13}{'peak MB':>9}  outcome"
+    print(header)
+    print("-" * len(header))
+    for row in results:
+        outcome = row["error"] or f"{row['success']} sent, {row['failed']} failed, {row['skipped'] or 0} skipped"
+        peak = f"{row['peak_memory_mb']:.1f}" if row["peak_memory_mb"] is not None else "-"
+        print(
+            f"{row['entity']:<9}{row['records']:>9}{row['seconds']:>10.3f}{row['records_per_second'] or 0:>11.1f}"
+            f"{row['crm_requests_per_record']:>13.4f}{row['moengage_requests_per_record']:>13.4f}{peak:>9}  {outcome}"
+        )
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory(prefix="afi_bench_") as workdir:
+        _configure_environment(workdir)
+        s3, _ = install_fake_aws(BENCH_SETTINGS)
+
+        from sourcecode.httpClients import close_clients, set_transport
+
+        dynamics = DynamicsStandIn(page_size=args.page_size, owners=args.owners,
+                                   latency=args.crm_latency, error_rate=args.crm_error_rate, seed=args.seed)
+        moengage = MoEngageStandIn(latency=args.moengage_latency, error_rate=args.moengage_error_rate, seed=args.seed + 1)
+        set_transport("dynamics", dynamics.transport())
+        set_transport("moengage", moengage.transport())
+
+        results = []
+        try:
+            for entity in args.entities:
+                for size in args.sizes:
+                    results.append(await run_scenario(entity, size, dynamics, moengage, s3, mode=args.mode,
+                                                      measure_memory=not args.no_memory, verbose=args.verbose))
+        finally:
+            await close_clients()
+            set_transport("dynamics", None)
+            set_transport("moengage", None)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        _print_table(results)
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")], default=list(DEFAULT_SIZES),
+                        help="comma-separated window sizes in records (default: 1000,10000,100000)")
+    parser.add_argument("--entities", type=lambda value: value.split(","), default=list(ENTITIES),
+                        help="comma-separated subset of leads,contacts,accounts")
+    parser.add_argument("--mode", choices=("window", "delta"), default="window", help="contacts/accounts sync mode")
+    parser.add_argument("--page-size", type=int, default=5000, help="records per OData page")
+    parser.add_argument("--owners", type=int, default=200, help="distinct lead owners")
+    parser.add_argument("--crm-latency", type=float, default=0.0, help="seconds added to every Dynamics response")
+    parser.add_argument("--crm-error-rate", type=float, default=0.0, help="fraction of Dynamics requests answered with 503")
+    parser.add_argument("--moengage-latency", type=float, default=0.0, help="seconds added to every MoEngage response")
+    parser.add_argument("--moengage-error-rate", type=float, default=0.0, help="fraction of MoEngage requests answered with 500")
+    parser.add_argument("--seed", type=int, default=0, help="seed for injected errors")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc peak memory measurement")
+    parser.add_argument("--verbose", action="store_true", help="keep the app's own output")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(_parse_args()))
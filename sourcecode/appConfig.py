@@ -0,0 +1,96 @@
+import json
+import os
+import threading
+import time
+from fastapi import HTTPException
+
+
+# Where settings come from: "secretsmanager" (default), "file" or "env"
+CONFIG_BACKEND = os.getenv("CONFIG_BACKEND", "secretsmanager")
+CONFIG_SECRET_NAME = os.getenv("CONFIG_SECRET_NAME", "afi/crm/test")
+CONFIG_FILE = os.getenv("CONFIG_FILE", "config.json")
+
+# Cached settings are refreshed in the background after this long, so rotated secrets are picked up
+CONFIG_TTL_SECONDS = int(os.getenv("CONFIG_TTL_SECONDS", "900"))
+CONFIG_RETRY_SECONDS = int(os.getenv("CONFIG_RETRY_SECONDS", "60"))
+
+# Settings every module reads; missing keys default to an empty string
+CONFIG_KEYS = ("CRM_API_URL", "CRM_TOKEN_URL", "CRM_CLIENT_ID", "CRM_CLIENT_SECRET", "MOENGAGE_API_URL", "moe_token")
+
+_config = {"values": None, "next_refresh_at": 0.0, "refreshing": False}
+_config_lock = threading.Lock()
+
+
+def _load_from_secrets_manager():
+    import boto3
+    secrets_client = boto3.client("secretsmanager")
+    response = secrets_client.get_secret_value(SecretId=CONFIG_SECRET_NAME)
+    if "SecretString" in response:
+        return json.loads(response["SecretString"])
+    return json.loads(response["SecretBinary"])
+
+
+def _load_from_file():
+    with open(CONFIG_FILE, "r", encoding="utf-8") as config_file:
+        return json.load(config_file)
+
+
+def _load_from_env():
+    return {key: os.environ[key] for key in CONFIG_KEYS if key in os.environ}
+
+
+_BACKENDS = {
+    "secretsmanager": _load_from_secrets_manager,
+    "file": _load_from_file,
+    "env": _load_from_env,
+}
+
+
+def _load():
+    loader = _BACKENDS.get(CONFIG_BACKEND)
+    if loader is None:
+        raise ValueError(f"Unknown CONFIG_BACKEND '{CONFIG_BACKEND}'")
+    raw = loader()
+    if not raw:
+        raise ValueError(f"No settings returned by the {CONFIG_BACKEND} backend")
+    return {key: raw.get(key, "") for key in CONFIG_KEYS}
+
+
+def _refresh_in_background():
+    try:
+        values = _load()
+        _config["values"] = values
+        _config["next_refresh_at"] = time.monotonic() + CONFIG_TTL_SECONDS
+    except Exception as e:
+        # Keep serving the previous settings and try again shortly
+        print(f"Error refreshing settings, keeping cached values: {e}")
+        _config["next_refresh_at"] = time.monotonic() + CONFIG_RETRY_SECONDS
+    finally:
+        _config["refreshing"] = False
+
+
+def get_config():
+    """Return the shared settings dict, loading it on first use and refreshing it when stale."""
+    values = _config["values"]
+    if values is None:
+        with _config_lock:
+            if _config["values"] is None:
+                try:
+                    _config["values"] = _load()
+                except Exception as e:
+                    print(f"Error fetching settings from {CONFIG_BACKEND}: {e}")
+                    raise HTTPException(status_code=500, detail="Failed to load secrets")
+                _config["next_refresh_at"] = time.monotonic() + CONFIG_TTL_SECONDS
+            return _config["values"]
+
+    if time.monotonic() >= _config["next_refresh_at"] and not _config["refreshing"]:
+        with _config_lock:
+            if not _config["refreshing"]:
+                _config["refreshing"] = True
+                threading.Thread(target=_refresh_in_background, daemon=True).start()
+    return values
+
+
+def get_setting(name: str):
+    """Return one setting, e.g. ``get_setting("CRM_API_URL")``."""
+    return get_config()[name]
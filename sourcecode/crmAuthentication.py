@@ -1,70 +1,109 @@
+import asyncio
+import time
 import httpx
 import os
-import boto3,json
-from fastapi import HTTPException
+from sourcecode.appConfig import get_config
+from sourcecode.httpClients import get_dynamics_client
+from sourcecode.metrics import timed
+from sourcecode.sharedTask import start_shared_task
 
 
-# Initialize the AWS Secrets Manager client
-secrets_client = boto3.client("secretsmanager")
+# Refresh the cached token this many seconds before it actually expires
+TOKEN_REFRESH_MARGIN = int(os.getenv("CRM_TOKEN_REFRESH_MARGIN", "300"))
 
-def get_secret(secret_name: str):
-    """Fetch secrets from AWS Secrets Manager."""
-    try:
-        response = secrets_client.get_secret_value(SecretId=secret_name)
-        if "SecretString" in response:
-            return json.loads(response["SecretString"])
-        elif "SecretBinary" in response:
-            return json.loads(response["SecretBinary"])
-    except Exception as e:
-        raise HTTPException(status_code=404, detail="Secrets not found")
+# Process-wide token store shared by every router
+_token_cache = {"access_token": None, "expires_at": 0.0}
+_refresh_task = None
 
-# Load secrets
-secrets = get_secret("afi/crm/test")
 
-if secrets:
-    CRM_API_URL = secrets.get("CRM_API_URL", "")
-    CRM_TOKEN_URL = secrets.get("CRM_TOKEN_URL", "")
-    CRM_CLIENT_ID = secrets.get("CRM_CLIENT_ID", "")
-    CRM_CLIENT_SECRET = secrets.get("CRM_CLIENT_SECRET", "")
-    MOENGAGE_API_URL = secrets.get("MOENGAGE_API_URL", "")
-    moe_token = secrets.get("moe_token", "")
-else:
-    raise HTTPException(status_code=500, detail="Failed to load secrets")
+def _token_is_fresh():
+    """Return True if the cached token is usable and not due for refresh."""
+    return (
+        _token_cache["access_token"] is not None
+        and time.monotonic() < _token_cache["expires_at"] - TOKEN_REFRESH_MARGIN
+    )
 
 
+def _token_is_valid():
+    """Return True if the cached token has not expired yet."""
+    return _token_cache["access_token"] is not None and time.monotonic() < _token_cache["expires_at"]
 
 
+def _start_refresh():
+    """Return the in-flight refresh task, starting one if none is running."""
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = start_shared_task(_request_crm_token())
+    return _refresh_task
 
 
+def invalidate_crm_token(rejected: str = None):
+    """Drop the cached token so the next caller fetches a new one (e.g. after a 401).
 
+    With ``rejected``, the cache is only dropped while it still holds that token, so requests
+    that failed together with the same token cause a single refresh.
+    """
+    if rejected is not None and _token_cache["access_token"] != rejected:
+        return
+    _token_cache["access_token"] = None
+    _token_cache["expires_at"] = 0.0
 
 
 async def authenticate_crm():
-    """Authenticate and get a CRM access token."""
-    # Check if all required environment variables are loaded
-    if not CRM_TOKEN_URL or not CRM_CLIENT_ID or not CRM_CLIENT_SECRET or not CRM_API_URL:
+    """Return a CRM access token, refreshing it only when it is close to expiry."""
+    if _token_is_fresh():
+        return _token_cache["access_token"]
+
+    # Inside the refresh margin: refresh in the background and keep serving the current token
+    if _token_is_valid():
+        _start_refresh()
+        return _token_cache["access_token"]
+
+    # Single-flight: concurrent callers all await the same refresh request
+    return await asyncio.shield(_start_refresh())
+
+
+async def reauthenticated_headers(headers: dict):
+    """Return ``headers`` with a new bearer token, for retrying a request the CRM answered with 401."""
+    invalidate_crm_token(headers.get("Authorization", "").removeprefix("Bearer "))
+    token = await authenticate_crm()
+    return {**headers, "Authorization": f"Bearer {token}"}
+
+
+async def _request_crm_token():
+    """Run the client-credentials round trip and store the result in the token cache."""
+    settings = get_config()
+
+    # Check if all required settings are loaded
+    if not settings["CRM_TOKEN_URL"] or not settings["CRM_CLIENT_ID"] or not settings["CRM_CLIENT_SECRET"] or not settings["CRM_API_URL"]:
         raise ValueError("Missing one or more required environment variables.")
 
     # Prepare data for token request
     data = {
         "grant_type": "client_credentials",
-        "client_id": CRM_CLIENT_ID,
-        "client_secret": CRM_CLIENT_SECRET,
-        "resource": CRM_API_URL,
+        "client_id": settings["CRM_CLIENT_ID"],
+        "client_secret": settings["CRM_CLIENT_SECRET"],
+        "resource": settings["CRM_API_URL"],
     }
 
-    # Make the POST request to authenticate asynchronously
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(CRM_TOKEN_URL, data=data)
-            response.raise_for_status()  # Raise an HTTPError for bad responses (4xx or 5xx)
-            # If successful, print and return the access token
-            print("CRM authentication successful.")
-            return response.json().get("access_token")
-        except httpx.HTTPStatusError as http_err:
-            print(f"HTTP error occurred: {http_err}")
-            print(f"Response content: {response.text}")
-            raise Exception(f"CRM Authentication failed with status code {response.status_code}")
-        except Exception as err:
-            print(f"Other error occurred: {err}")
-            raise Exception("CRM Authentication failed due to an unexpected error.")
+    # Make the POST request to authenticate asynchronously on the shared Dynamics client
+    client = get_dynamics_client()
+    try:
+        with timed("token"):
+            response = await client.post(settings["CRM_TOKEN_URL"], data=data)
+        response.raise_for_status()  # Raise an HTTPError for bad responses (4xx or 5xx)
+        token_data = response.json()
+        access_token = token_data.get("access_token")
+        # Azure AD returns expires_in as a string of seconds
+        expires_in = int(token_data.get("expires_in", 3600))
+        _token_cache["access_token"] = access_token
+        _token_cache["expires_at"] = time.monotonic() + expires_in
+        print(f"CRM authentication successful, token valid for {expires_in}s.")
+        return access_token
+    except httpx.HTTPStatusError as http_err:
+        print(f"HTTP error occurred: {http_err}")
+        print(f"Response content: {response.text}")
+        raise Exception(f"CRM Authentication failed with status code {response.status_code}")
+    except Exception as err:
+        print(f"Other error occurred: {err}")
+        raise Exception("CRM Authentication failed due to an unexpected error.")
@@ -0,0 +1,389 @@
+import asyncio
+import os
+from contextlib import suppress
+from datetime import datetime, timedelta
+from typing import NamedTuple
+from fastapi import HTTPException
+from sourcecode.appConfig import get_setting
+from sourcecode.crmAuthentication import authenticate_crm, reauthenticated_headers
+from sourcecode.fieldMapping import paused_gc
+from sourcecode.httpClients import get_dynamics_client
+from sourcecode.jsonCodec import decode_page, dumps, loads
+from sourcecode.logSink import log_error
+from sourcecode.metrics import timed
+from sourcecode.odataBatch import batched_get
+from sourcecode.syncCheckpoint import format_odata_datetime, load_checkpoint, load_watermark, parse_odata_datetime, safe_watermark, save_checkpoint, save_watermark
+
+
+# Pages downloaded ahead of the push stage; bounds memory to a few pages per sync
+CRM_PREFETCH_PAGES = int(os.getenv("CRM_PREFETCH_PAGES", "2"))
+
+# Default contacts/accounts sync mode: "window" (modifiedon filter) or "delta" (change tracking)
+CRM_SYNC_MODE = os.getenv("CRM_SYNC_MODE", "window")
+if CRM_SYNC_MODE not in ("window", "delta"):
+    raise ValueError(f"Unknown CRM_SYNC_MODE {CRM_SYNC_MODE!r}; use window or delta")
+
+# Ids per lookup query when resolving related records for change-tracking pages
+LOOKUP_CHUNK_SIZE = 50
+
+# Time slices a window is split into and fetched in parallel; 1 pages the window sequentially
+CRM_FETCH_SHARDS = int(os.getenv("CRM_FETCH_SHARDS", "1"))
+CRM_SHARD_CONCURRENCY = int(os.getenv("CRM_SHARD_CONCURRENCY", "4"))
+
+
+class Lookup(NamedTuple):
+    """Related records a change-tracking page resolves itself, since it cannot ``$expand``.
+
+    The ``lookup_field`` ids are read from ``entity_set`` by its ``key`` and attached to each
+    record under ``navigation``.
+    """
+
+    lookup_field: str
+    navigation: str
+    entity_set: str
+    key: str
+
+
+async def iter_pages(url: str, headers: dict, label: str, tracking: dict = None, fields=None):
+    """Yield the ``value`` array of every page of an OData query, following ``@odata.nextLink``.
+
+    When ``tracking`` is given, the ``@odata.deltaLink`` returned with the last page of a
+    change-tracking query is stored in ``tracking["delta_link"]``. ``fields`` lets the
+    codec decode only those record keys (see ``jsonCodec.decode_page``). A page answered
+    with 401 is fetched once more with a new token.
+    """
+    client = get_dynamics_client()
+    retried = False
+    while url:
+        with timed("page_fetch"):
+            response = await client.get(url, headers=headers)
+        if response.status_code == 401 and not retried:
+            # The token was revoked or expired before its stated lifetime: get a new one
+            print(f"CRM rejected the token while fetching {label}, retrying with a new one")
+            headers = await reauthenticated_headers(headers)
+            retried = True
+            continue
+        retried = False
+        if response.status_code != 200:
+            print(f"Failed to fetch {label}: {response.status_code} - {response.text}")
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"Failed to fetch {label} from CRM: {response.status_code} - {response.text}",
+            )
+
+        with paused_gc():
+            data = decode_page(response.content, fields)
+        url = data.get("@odata.nextLink")
+        if url:
+            print(f"Fetching more {label} from {url}")
+        elif tracking is not None and data.get("@odata.deltaLink"):
+            tracking["delta_link"] = data["@odata.deltaLink"]
+        yield data.get("value", [])
+
+
+def split_deleted(page):
+    """Split a change-tracking page into changed records and the ids of deleted records."""
+    changed = []
+    deleted = []
+    for record in page:
+        if record.get("reason") == "deleted" or str(record.get("@odata.context", "")).endswith("$deletedEntity"):
+            deleted.append(record.get("id"))
+        else:
+            changed.append(record)
+    return changed, deleted
+
+
+async def expand_lookups(records, headers: dict, api_url: str, lookup_field: str, navigation: str, entity_set: str, key: str, select: str):
+    """Attach related records the way ``$expand`` would, for queries that cannot use it.
+
+    Change-tracking queries do not support ``$expand``, so the distinct ``lookup_field`` ids
+    of a page are resolved with one ``entity_set`` query per chunk, sent together through
+    ``batched_get``, and stored on each record under ``navigation``.
+    """
+    ids = list({record[lookup_field] for record in records if record.get(lookup_field)})
+    # A filtered lookup is not a change-tracking query, so it must not carry that preference
+    headers = {name: value for name, value in headers.items() if name != "Prefer"}
+    urls = []
+    for start in range(0, len(ids), LOOKUP_CHUNK_SIZE):
+        lookup_filter = " or ".join(f"{key} eq {value}" for value in ids[start:start + LOOKUP_CHUNK_SIZE])
+        urls.append(f"{api_url}/api/data/v9.0/{entity_set}?$filter={lookup_filter}&$select={key},{select}")
+
+    # Chunk queries are independent and share one $batch round trip
+    with timed("lookup"):
+        responses = await asyncio.gather(*(batched_get(url, headers) for url in urls))
+
+    found = {}
+    for response in responses:
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"Failed to look up {entity_set} from CRM: {response.status_code} - {response.text}",
+            )
+        for related in loads(response.content).get("value", []):
+            found[related[key]] = related
+
+    for record in records:
+        record[navigation] = found.get(record.get(lookup_field))
+
+
+async def iter_window_pages(entity_set: str, mapping, field: str, since: str = None, shards: int = 1, fields=None):
+    """Yield pages of ``entity_set`` with ``field`` at or after ``since`` (default: the last hour), oldest first.
+
+    The query selects and expands the ``mapping`` columns. With ``shards`` above 1 the
+    window is fetched as parallel time slices and pages arrive out of order. ``fields`` is
+    passed on to ``iter_pages``.
+    """
+    token = await authenticate_crm()
+    if not token:
+        raise HTTPException(status_code=401, detail="Failed to retrieve access token")
+
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+    }
+
+    # Default to the last hour, formatted as a UTC DateTimeOffset for the CRM API
+    period = since or format_odata_datetime(datetime.utcnow() - timedelta(hours=1))
+
+    def window_url(row_filter: str):
+        return (f"{get_setting('CRM_API_URL')}/api/data/v9.0/{entity_set}?$filter={row_filter}"
+                f"&$orderby={field} asc&$select={mapping.select}&$expand={mapping.expand}")
+
+    if shards > 1:
+        pages = iter_sharded_pages(window_url, headers, entity_set, field, period, mapping.key, shards, fields=fields)
+    else:
+        pages = iter_pages(window_url(f"{field} ge {period}"), headers, entity_set, fields=fields)
+    async for page in pages:
+        yield page
+
+
+async def iter_changes(entity_set: str, mapping, lookups, tracking: dict):
+    """Yield ``(changed, deleted_ids)`` pages of ``entity_set`` from Dataverse change tracking.
+
+    Starts from ``tracking["delta_link"]`` when there is one, otherwise does the initial
+    tracked read of the ``mapping`` columns; the new delta link is written back into
+    ``tracking`` after the last page. Each ``Lookup`` in ``lookups`` is resolved per page.
+    """
+    token = await authenticate_crm()
+    if not token:
+        raise HTTPException(status_code=401, detail="Failed to retrieve access token")
+
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+        "Prefer": "odata.track-changes",
+    }
+
+    # Change tracking does not allow $filter, $orderby or $expand
+    api_url = get_setting("CRM_API_URL")
+    url = tracking.get("delta_link") or f"{api_url}/api/data/v9.0/{entity_set}?$select={mapping.select}"
+
+    async for page in iter_pages(url, headers, f"{mapping.entity} changes", tracking):
+        changed, deleted = split_deleted(page)
+        # Lookups run together so their queries share one $batch
+        await asyncio.gather(*(
+            expand_lookups(changed, headers, api_url, lookup.lookup_field, lookup.navigation, lookup.entity_set,
+                           lookup.key, mapping.expand_columns(lookup.navigation))
+            for lookup in lookups
+        ))
+        yield changed, deleted
+
+
+def split_time_range(start: datetime, end: datetime, shards: int):
+    """Split ``[start, end)`` into ``shards`` equal ``(lower, upper)`` slices."""
+    step = (end - start) / shards
+    return [(start + step * index, start + step * (index + 1)) for index in range(shards)]
+
+
+async def iter_sharded_pages(build_url, headers: dict, label: str, field: str, since: str, key: str,
+                             shards: int = None, concurrency: int = None, fields=None):
+    """Yield the pages of a ``field ge since`` window, fetched as concurrent time slices.
+
+    The range from ``since`` to now is split into ``shards`` slices; ``build_url`` turns a
+    ``$filter`` expression into a query URL. Up to ``concurrency`` slices are paged at once
+    and their pages are yielded as they arrive, so pages are not in ``field`` order. The
+    last slice has no upper bound, like the unsharded query. A record that moves between
+    slices while the window is read is yielded once, by its ``key``.
+    """
+    shards = max(1, shards or CRM_FETCH_SHARDS)
+    slices = split_time_range(parse_odata_datetime(since), datetime.utcnow(), shards)
+    semaphore = asyncio.Semaphore(max(1, concurrency or CRM_SHARD_CONCURRENCY))
+    queue = asyncio.Queue(maxsize=CRM_PREFETCH_PAGES)
+    finished = object()
+
+    async def fetch_slice(index, lower, upper):
+        range_filter = f"{field} ge {format_odata_datetime(lower)}"
+        if index < len(slices) - 1:
+            range_filter += f" and {field} lt {format_odata_datetime(upper)}"
+        async with semaphore:
+            async for page in iter_pages(build_url(range_filter), headers, f"{label} (slice {index + 1}/{len(slices)})", fields=fields):
+                await queue.put(page)
+
+    async def produce():
+        tasks = [asyncio.ensure_future(fetch_slice(index, lower, upper)) for index, (lower, upper) in enumerate(slices)]
+        try:
+            await asyncio.gather(*tasks)
+        except Exception as e:
+            await queue.put(e)
+            return
+        finally:
+            # One failed slice fails the window, so stop paging the others
+            for task in tasks:
+                task.cancel()
+        await queue.put(finished)
+
+    seen = set()
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            page = []
+            for record in item:
+                record_key = record.get(key)
+                if record_key in seen:
+                    continue
+                if record_key is not None:
+                    seen.add(record_key)
+                page.append(record)
+            yield page
+    finally:
+        producer.cancel()
+        with suppress(asyncio.CancelledError):
+            await producer
+
+
+async def prefetch_pages(pages, queue_size: int = None):
+    """Run a page stream in the background through a bounded queue.
+
+    The next page downloads while the caller is still mapping and sending the current one,
+    and at most ``queue_size`` pages are held in memory. Errors from the page stream are
+    re-raised to the caller.
+    """
+    queue = asyncio.Queue(maxsize=queue_size or CRM_PREFETCH_PAGES)
+    finished = object()
+
+    async def produce():
+        try:
+            async for page in pages:
+                await queue.put(page)
+        except Exception as e:
+            await queue.put(e)
+            return
+        await queue.put(finished)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        producer.cancel()
+        with suppress(asyncio.CancelledError):
+            await producer
+        await pages.aclose()
+
+
+async def sync_window(entity: str, iter_window, push_page, field: str, shards: int = 1, fields=None):
+    """Push every record of ``entity`` changed since its watermark and checkpoint progress.
+
+    ``iter_window(since, shards, fields)`` yields the pages of the window and
+    ``push_page(page)`` sends one page, returning ``push_records`` counts. ``fields`` names
+    the columns the push reads, so the codec can skip the rest (see ``iter_pages``). Pages are pushed while the next one
+    downloads. A sequential run advances the watermark to the last ``field`` value before
+    the first failure; sharded pages arrive out of order, so a sharded run checkpoints the
+    window end once, after the whole window went through without failures. Returns the
+    summed ``success``/``failed``/``skipped`` counts.
+    """
+    counts = {"success": 0, "failed": 0, "skipped": 0}
+    since = await load_watermark(entity)
+    window_end = format_odata_datetime(datetime.utcnow())
+    blocked = False
+
+    async for page in prefetch_pages(iter_window(since, shards, fields)):
+        page_counts = await push_page(page)
+        for outcome in counts:
+            counts[outcome] += page_counts.get(outcome, 0)
+
+        # Checkpoint progress so a failed or late run resumes from here
+        if not blocked and shards == 1:
+            watermark, blocked = safe_watermark(page, page_counts["failed_records"], field)
+            if watermark:
+                await save_watermark(entity, watermark)
+    if shards > 1 and counts["failed"] == 0:
+        await save_watermark(entity, window_end)
+    return counts
+
+
+async def sync_changes(entity: str, mapping, lookups, push_page):
+    """Push the changes of ``entity`` since its stored delta link and report deleted records.
+
+    ``entity`` is also the entity set queried (see ``iter_changes``) and ``push_page(page)``
+    sends one page, returning ``push_records`` counts. The new delta link is checkpointed
+    only when every record went through. Returns the summed ``success``/``failed``/``skipped``
+    counts and the ``deleted`` ids.
+    """
+    tracking = {"delta_link": await load_checkpoint(f"deltalink:{entity}")}
+    counts = {"success": 0, "failed": 0, "skipped": 0}
+    deleted_ids = []
+
+    async for changed, deleted in prefetch_pages(iter_changes(entity, mapping, lookups, tracking)):
+        page_counts = await push_page(changed)
+        for outcome in counts:
+            counts[outcome] += page_counts.get(outcome, 0)
+        deleted_ids.extend(deleted)
+
+    # Keep the old delta link after failures so the next run sees the same changes again
+    if counts["failed"] == 0 and tracking.get("delta_link"):
+        await save_checkpoint(f"deltalink:{entity}", tracking["delta_link"])
+
+    if deleted_ids:
+        print(f"{entity.capitalize()} deleted in CRM: {', '.join(str(record_id) for record_id in deleted_ids)}")
+
+    return {**counts, "deleted": deleted_ids}
+
+
+async def stream_ndjson(pages, label: str):
+    """Return an NDJSON body for a page stream: one record per line, sent page by page.
+
+    The first page is fetched before returning, so a request that fails up front (token,
+    first query) still raises in the endpoint and gets an error status. A failure after
+    the body has started is logged and reported as a final ``{"error": ...}`` line, since
+    the status line has already been sent.
+    """
+    pages = pages.__aiter__()
+    try:
+        first = await pages.__anext__()
+    except StopAsyncIteration:
+        first = []
+        done = True
+    else:
+        done = False
+
+    async def lines():
+        page = first
+        try:
+            while True:
+                if page:
+                    yield b"".join(dumps(record) + b"\n" for record in page)
+                if done:
+                    return
+                try:
+                    page = await pages.__anext__()
+                except StopAsyncIteration:
+                    return
+        except Exception as e:
+            message = f"Failed to stream {label}: {str(e)}"
+            log_error(message)
+            yield dumps({"error": message}) + b"\n"
+        finally:
+            await pages.aclose()
+
+    return lines()
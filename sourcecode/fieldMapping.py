@@ -0,0 +1,175 @@
+import functools
+import gc
+import os
+from contextlib import contextmanager
+from typing import Callable, NamedTuple
+
+
+# Pause the cyclic garbage collector while a page is decoded or mapped
+PAGE_PAUSE_GC = os.getenv("PAGE_PAUSE_GC", "true").lower() == "true"
+
+
+@contextmanager
+def paused_gc():
+    """Suspend cyclic garbage collection for an allocation-heavy, synchronous page step.
+
+    Decoding and mapping a page allocates tens of thousands of acyclic dicts and lists,
+    which keeps triggering collections that rescan the whole heap. Reference counting
+    still frees everything; the collector simply runs once the step is over.
+    """
+    if not PAGE_PAUSE_GC or not gc.isenabled():
+        yield
+        return
+    gc.disable()
+    try:
+        yield
+    finally:
+        gc.enable()
+
+
+class Column(NamedTuple):
+    """MoEngage attribute copied from a CRM column."""
+    attribute: str
+    column: str
+
+
+class Related(NamedTuple):
+    """Attribute read from an expanded related record; None when there is no related record.
+
+    ``default`` is used when the related record exists but lacks ``column``. ``lookup_field``
+    is the lookup column behind ``navigation``, selected so change-tracking queries (which
+    cannot ``$expand``) can resolve the related record themselves.
+    """
+    attribute: str
+    navigation: str
+    column: str
+    default: object = None
+    lookup_field: str = None
+
+
+class OptionLabel(NamedTuple):
+    """Attribute holding the label of an option set value, from the labels passed to the mapper."""
+    attribute: str
+    column: str
+    default: object = None
+
+
+class Resolved(NamedTuple):
+    """Attribute computed by calling ``resolve`` with the value of ``column``."""
+    attribute: str
+    column: str
+    resolve: Callable
+
+
+class EntityMapping:
+    """Single definition of how one CRM entity becomes MoEngage transition payloads.
+
+    The field list drives both the query (``select`` and ``expand``) and ``map_page``, a
+    mapper compiled once from the fields into straight-line code: one dict literal per
+    record, with no per-field dispatch at run time. Label tables and the customer id are
+    resolved once per page, and the page is mapped with the garbage collector paused.
+    """
+
+    def __init__(self, entity: str, fields, customer_id_column: str = "emailaddress1", device_id: str = None,
+                 key: str = None, volatile=()):
+        self.entity = entity
+        self.fields = tuple(fields)
+        # Dataverse names the primary key after the entity, e.g. leadid
+        self.key = key or f"{entity}id"
+        self.customer_id_column = customer_id_column
+        self.device_id = device_id
+
+        attributes = [field.attribute for field in self.fields]
+        duplicates = sorted({attribute for attribute in attributes if attributes.count(attribute) > 1})
+        if duplicates:
+            raise ValueError(f"{entity} mapping defines {', '.join(duplicates)} more than once")
+        # Attributes that change on every edit of the record, left out of change detection
+        self.volatile = frozenset(volatile)
+        unknown = sorted(self.volatile.difference(attributes))
+        if unknown:
+            raise ValueError(f"{entity} mapping marks unknown attributes {', '.join(unknown)} as volatile")
+
+        columns = [customer_id_column]
+        self._navigations = {}
+        for field in self.fields:
+            if isinstance(field, Related):
+                self._navigations.setdefault(field.navigation, [])
+                if field.column not in self._navigations[field.navigation]:
+                    self._navigations[field.navigation].append(field.column)
+                if field.lookup_field:
+                    columns.append(field.lookup_field)
+            else:
+                columns.append(field.column)
+        self.select = ",".join(dict.fromkeys(columns))
+        self.expand = ",".join(f"{navigation}($select={','.join(related)})" for navigation, related in self._navigations.items())
+        # Every top-level key the queries, paging and mapper read from a record
+        self.columns = tuple(dict.fromkeys([self.key, *columns, *self._navigations]))
+        self.option_sets = tuple(dict.fromkeys(field.column for field in self.fields if isinstance(field, OptionLabel)))
+
+        self.source, compiled = self._compile()
+        self.map_page = self._without_gc(compiled)
+
+    def expand_columns(self, navigation: str):
+        """Comma-separated columns read from the related records behind ``navigation``."""
+        return ",".join(self._navigations[navigation])
+
+    def map_record(self, record, labels: dict = None):
+        """Map a single record; prefer ``map_page`` for whole pages."""
+        return self.map_page((record,), labels)[0]
+
+    @staticmethod
+    def _without_gc(map_page):
+        @functools.wraps(map_page)
+        def wrapper(records, labels=None):
+            with paused_gc():
+                return map_page(records, labels)
+        return wrapper
+
+    def _compile(self):
+        navigations = {navigation: f"related_{index}" for index, navigation in enumerate(self._navigations)}
+        option_sets = {column: f"labels_{index}" for index, column in enumerate(self.option_sets)}
+        namespace = {}
+
+        lines = ["def map_page(records, labels=None):", "    labels = labels or {}"]
+        lines += [f"    {name} = labels.get({column!r}) or {{}}" for column, name in option_sets.items()]
+        lines += [
+            "    payloads = []",
+            "    append = payloads.append",
+            "    for record in records:",
+            "        get = record.get",
+            f"        customer_id = get({self.customer_id_column!r})",
+        ]
+        lines += [f"        {name} = get({navigation!r})" for navigation, name in navigations.items()]
+        lines.append("        attributes = {")
+        for index, field in enumerate(self.fields):
+            if isinstance(field, Related):
+                name = navigations[field.navigation]
+                value = f"{name}.get({field.column!r}, {field.default!r}) if {name} else None"
+            elif isinstance(field, OptionLabel):
+                value = f"{option_sets[field.column]}.get(get({field.column!r}), {field.default!r})"
+            elif isinstance(field, Resolved):
+                namespace[f"resolve_{index}"] = field.resolve
+                value = f"resolve_{index}(get({field.column!r}))"
+            else:
+                value = f"get({field.column!r})"
+            lines.append(f"            {field.attribute!r}: {value},")
+        lines.append("        }")
+
+        event = '{"type": "event", "customer_id": customer_id, '
+        if self.device_id is not None:
+            event += f'"device_id": {self.device_id!r}, '
+        event += '"actions": []}'
+        lines += [
+            "        append({",
+            '            "type": "transition",',
+            '            "elements": [',
+            '                {"type": "customer", "customer_id": customer_id, "attributes": attributes},',
+            f"                {event},",
+            "            ],",
+            "        })",
+            "    return payloads",
+        ]
+
+        source = "\n".join(lines) + "\n"
+        exec(compile(source, f"<{self.entity} mapping>", "exec"), namespace)
+        return source, namespace["map_page"]
@@ -0,0 +1,77 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+
+
+# Local SQLite database holding the last delivered attribute hashes per customer
+FINGERPRINT_DB_PATH = os.getenv("FINGERPRINT_DB_PATH", "/tmp/afi_fingerprints.sqlite")
+
+# SQLite limits the number of bound parameters per statement
+_LOOKUP_CHUNK_SIZE = 500
+
+
+def _digest(value):
+    encoded = json.dumps(value, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.blake2b(encoded, digest_size=8).hexdigest()
+
+
+def fingerprint_attributes(attributes: dict, ignore=()):
+    """Return ``(digest, attribute_digests)`` for a mapped MoEngage attribute dict.
+
+    Attributes named in ``ignore`` (e.g. a modified-on timestamp that changes with every edit)
+    are left out, so a record is unchanged when only those attributes differ.
+    """
+    attribute_digests = {name: _digest(value) for name, value in attributes.items() if name not in ignore}
+    return _digest(attribute_digests), attribute_digests
+
+
+def _connect():
+    connection = sqlite3.connect(FINGERPRINT_DB_PATH)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS fingerprints ("
+        "entity TEXT NOT NULL, customer_id TEXT NOT NULL, digest TEXT NOT NULL, attributes TEXT NOT NULL, "
+        "PRIMARY KEY (entity, customer_id))"
+    )
+    return connection
+
+
+def _load(entity: str, customer_ids):
+    found = {}
+    with _connect() as connection:
+        for start in range(0, len(customer_ids), _LOOKUP_CHUNK_SIZE):
+            chunk = customer_ids[start:start + _LOOKUP_CHUNK_SIZE]
+            placeholders = ",".join("?" for _ in chunk)
+            rows = connection.execute(
+                f"SELECT customer_id, digest, attributes FROM fingerprints WHERE entity = ? AND customer_id IN ({placeholders})",
+                (entity, *chunk),
+            )
+            for customer_id, digest, attributes in rows:
+                found[customer_id] = (digest, json.loads(attributes))
+    return found
+
+
+def _save(entity: str, fingerprints: dict):
+    with _connect() as connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO fingerprints (entity, customer_id, digest, attributes) VALUES (?, ?, ?, ?)",
+            [
+                (entity, customer_id, digest, json.dumps(attribute_digests))
+                for customer_id, (digest, attribute_digests) in fingerprints.items()
+            ],
+        )
+
+
+async def load_fingerprints(entity: str, customer_ids):
+    """Return ``{customer_id: (digest, attribute_digests)}`` for the customers already delivered."""
+    customer_ids = list({customer_id for customer_id in customer_ids if customer_id})
+    if not customer_ids:
+        return {}
+    return await asyncio.to_thread(_load, entity, customer_ids)
+
+
+async def save_fingerprints(entity: str, fingerprints: dict):
+    """Record the fingerprints of customers that MoEngage accepted."""
+    if fingerprints:
+        await asyncio.to_thread(_save, entity, fingerprints)
@@ -0,0 +1,122 @@
+import os
+import httpx
+from sourcecode.appConfig import get_setting
+from sourcecode.metrics import record_upstream_response
+from sourcecode.requestBudget import DYNAMICS_REQUESTS_PER_SECOND, get_dynamics_budget
+from sourcecode.resilience import ResilientTransport
+
+
+# Connection pool and timeout tuning, overridable per deployment
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "10"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() == "true"
+
+# One shared client per upstream, created lazily or by the app lifespan
+_clients = {}
+
+# Optional httpx transport per upstream, e.g. local stand-ins for offline benchmarks
+_transports = {}
+
+
+def _http2_available():
+    """HTTP/2 needs the optional h2 package; fall back to HTTP/1.1 without it."""
+    if not HTTP2_ENABLED:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        print("HTTP2_ENABLED is set but the h2 package is not installed, using HTTP/1.1")
+        return False
+    return True
+
+
+def _response_hook(upstream: str):
+    async def record(response):
+        # Read the body here so its size can be counted; callers read it from memory afterwards
+        await response.aread()
+        try:
+            bytes_out = len(response.request.content)
+        except httpx.RequestNotRead:
+            bytes_out = 0
+        record_upstream_response(upstream, response.status_code, bytes_out, len(response.content))
+    return record
+
+
+def _is_dataverse_request(request: httpx.Request):
+    # The Dynamics client also posts to the Azure AD token endpoint, which the Dataverse
+    # request limits do not cover
+    return request.url.host == httpx.URL(get_setting("CRM_API_URL")).host
+
+
+def _build_transport(upstream: str):
+    """Network (or injected) transport wrapped with retries, adaptive concurrency and, for
+    Dataverse requests, the request budget shared by every router."""
+    transport = _transports.get(upstream) or httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        http2=_http2_available(),
+    )
+    budget = get_dynamics_budget() if upstream == "dynamics" and DYNAMICS_REQUESTS_PER_SECOND > 0 else None
+    return ResilientTransport(upstream, transport, budget=budget, budget_applies=_is_dataverse_request)
+
+
+def _build_client(upstream: str):
+    return httpx.AsyncClient(
+        event_hooks={"response": [_response_hook(upstream)]},
+        timeout=httpx.Timeout(
+            HTTP_READ_TIMEOUT,
+            connect=HTTP_CONNECT_TIMEOUT,
+            pool=HTTP_POOL_TIMEOUT,
+        ),
+        transport=_build_transport(upstream),
+    )
+
+
+def _get_client(upstream: str):
+    client = _clients.get(upstream)
+    if client is None or client.is_closed:
+        client = _clients[upstream] = _build_client(upstream)
+    return client
+
+
+def set_transport(upstream: str, transport):
+    """Route an upstream ("dynamics" or "moengage") through ``transport``; None restores the network.
+
+    The current client of that upstream is dropped, so the next call builds one on the new
+    transport. Close clients with ``close_clients`` first when they are in use.
+    """
+    if transport is None:
+        _transports.pop(upstream, None)
+    else:
+        _transports[upstream] = transport
+    _clients.pop(upstream, None)
+
+
+def get_dynamics_client():
+    """Shared client for Dynamics 365 Web API calls and the CRM token endpoint."""
+    return _get_client("dynamics")
+
+
+def get_moengage_client():
+    """Shared client for MoEngage API calls."""
+    return _get_client("moengage")
+
+
+def open_clients():
+    """Create the upstream clients up front; called from the app lifespan."""
+    get_dynamics_client()
+    get_moengage_client()
+
+
+async def close_clients():
+    """Close every upstream client and release pooled connections."""
+    while _clients:
+        _, client = _clients.popitem()
+        await client.aclose()
@@ -0,0 +1,125 @@
+import functools
+import json
+import os
+from typing import Any, List, TypedDict
+
+
+# JSON library for CRM pages, MoEngage bodies and API responses: "auto" (msgspec, then
+# orjson, then the standard library), "msgspec", "orjson" or "json"
+JSON_CODEC = os.getenv("JSON_CODEC", "auto").lower()
+
+_CODEC_PREFERENCE = ("msgspec", "orjson", "json")
+
+
+class StdlibCodec:
+    """The standard library ``json`` module; always available."""
+
+    name = "json"
+
+    def loads(self, content):
+        return json.loads(content)
+
+    def dumps(self, value) -> bytes:
+        return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+    def page_decoder(self, fields):
+        # No typed decoding: the page is decoded whole and ``fields`` only narrows it with msgspec
+        return self.loads
+
+
+class OrjsonCodec(StdlibCodec):
+    """orjson: the same untyped dicts as the standard library, several times faster."""
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self._loads = orjson.loads
+        self._dumps = orjson.dumps
+        self._options = orjson.OPT_NON_STR_KEYS
+
+    def loads(self, content):
+        return self._loads(content)
+
+    def dumps(self, value) -> bytes:
+        return self._dumps(value, option=self._options)
+
+
+class MsgspecCodec(StdlibCodec):
+    """msgspec: fast untyped decoding, plus page decoders that keep only the named fields."""
+
+    name = "msgspec"
+
+    def __init__(self):
+        import msgspec
+        self._msgspec = msgspec
+        self._decoder = msgspec.json.Decoder()
+        self._encoder = msgspec.json.Encoder()
+
+    def loads(self, content):
+        return self._decoder.decode(content)
+
+    def dumps(self, value) -> bytes:
+        return self._encoder.encode(value)
+
+    def page_decoder(self, fields):
+        # Unknown keys are skipped without being decoded, so OData annotations and any
+        # column outside ``fields`` never become Python objects
+        record = TypedDict("Record", {field: Any for field in fields}, total=False)
+        page = TypedDict("Page", {"value": List[record], "@odata.nextLink": str, "@odata.deltaLink": str}, total=False)
+        return self._msgspec.json.Decoder(page).decode
+
+
+_CODECS = {"json": StdlibCodec, "orjson": OrjsonCodec, "msgspec": MsgspecCodec}
+
+
+def get_codec(name: str = None):
+    """Return the codec called ``name``, falling back to the next available library.
+
+    A library that is configured but not installed is reported and skipped, like
+    HTTP/2 without ``h2``; the standard library codec is always available.
+    """
+    name = (name or JSON_CODEC).lower()
+    if name == "auto":
+        candidates = _CODEC_PREFERENCE
+    elif name in _CODECS:
+        candidates = _CODEC_PREFERENCE[_CODEC_PREFERENCE.index(name):]
+    else:
+        raise ValueError(f"Unknown JSON_CODEC {name!r}; use auto, {', '.join(_CODEC_PREFERENCE)}")
+
+    for candidate in candidates:
+        try:
+            return _CODECS[candidate]()
+        except ImportError:
+            if name != "auto":
+                print(f"JSON_CODEC is {name} but the {candidate} package is not installed, trying the next codec")
+    return StdlibCodec()
+
+
+_codec = get_codec()
+
+
+def loads(content):
+    """Decode JSON ``bytes`` or ``str`` with the configured codec."""
+    return _codec.loads(content)
+
+
+def dumps(value) -> bytes:
+    """Encode ``value`` as compact UTF-8 JSON with the configured codec."""
+    return _codec.dumps(value)
+
+
+@functools.lru_cache(maxsize=None)
+def _page_decoder(fields):
+    return _codec.page_decoder(fields)
+
+
+def decode_page(content, fields=None):
+    """Decode an OData page; with ``fields`` and msgspec, records keep only those keys.
+
+    ``fields`` must name every column the caller reads, including the primary key and
+    expanded navigation properties (see ``EntityMapping.columns``).
+    """
+    if fields is None:
+        return _codec.loads(content)
+    return _page_decoder(tuple(fields))(content)
@@ -0,0 +1,157 @@
+import asyncio
+import gzip
+import json
+import os
+import time
+import uuid
+from contextlib import suppress
+from datetime import datetime, timezone
+
+
+# Destination: S3 bucket by default, or a local directory when LOG_DIR is set (offline runs, tests)
+LOG_BUCKET_NAME = os.getenv("LOG_BUCKET_NAME", "apierrorlog")
+LOG_DIR = os.getenv("LOG_DIR", "")
+
+# Flush thresholds for the in-memory buffer
+LOG_FLUSH_MAX_RECORDS = int(os.getenv("LOG_FLUSH_MAX_RECORDS", "500"))
+LOG_FLUSH_MAX_BYTES = int(os.getenv("LOG_FLUSH_MAX_BYTES", "1000000"))
+LOG_FLUSH_INTERVAL_SECONDS = float(os.getenv("LOG_FLUSH_INTERVAL_SECONDS", "30"))
+
+# Key prefix per record kind
+LOG_PREFIXES = {
+    "error": "errorlogs/",
+    "processed_records": "processedRecords/",
+}
+
+_buffer = []
+_buffer_state = {"bytes": 0, "oldest": None}
+_flush_task = None
+_periodic_task = None
+_s3_client = None
+
+
+def _get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        import boto3
+        from botocore.config import Config
+        _s3_client = boto3.client("s3", config=Config(retries={"max_attempts": 3, "mode": "standard"}))
+    return _s3_client
+
+
+def _object_key(kind: str):
+    # The random suffix keeps two flushes in the same second from overwriting each other
+    now = datetime.now(timezone.utc)
+    prefix = LOG_PREFIXES.get(kind, f"{kind}/")
+    return f"{prefix}{now.strftime('%Y/%m/%d/%H-%M-%S')}_{uuid.uuid4().hex}.ndjson.gz"
+
+
+def _write_batch(lines):
+    """Write buffered NDJSON lines as one gzip object per record kind."""
+    by_kind = {}
+    for kind, line in lines:
+        by_kind.setdefault(kind, []).append(line)
+
+    for kind, kind_lines in by_kind.items():
+        body = gzip.compress(("\n".join(kind_lines) + "\n").encode("utf-8"))
+        key = _object_key(kind)
+        try:
+            if LOG_DIR:
+                path = os.path.join(LOG_DIR, key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as log_file:
+                    log_file.write(body)
+            else:
+                _get_s3_client().put_object(
+                    Body=body, Bucket=LOG_BUCKET_NAME, Key=key,
+                    ContentType="application/x-ndjson", ContentEncoding="gzip",
+                )
+            print(f"Logged {len(kind_lines)} {kind} record(s) to {LOG_DIR or f'S3://{LOG_BUCKET_NAME}'}/{key}")
+        except Exception as e:
+            # Logging must never fail the request that produced the record
+            print(f"Failed to ship {len(kind_lines)} {kind} log record(s): {e}")
+
+
+def _take_buffer():
+    lines = _buffer[:]
+    _buffer.clear()
+    _buffer_state["bytes"] = 0
+    _buffer_state["oldest"] = None
+    return lines
+
+
+async def flush():
+    """Write everything buffered so far, off the event loop."""
+    lines = _take_buffer()
+    if lines:
+        await asyncio.to_thread(_write_batch, lines)
+
+
+def _schedule_flush():
+    global _flush_task
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # No event loop (scripts, shutdown): write synchronously
+        _write_batch(_take_buffer())
+        return
+    if _flush_task is None or _flush_task.done():
+        _flush_task = loop.create_task(flush())
+
+
+def log_event(kind: str, message: str = None, **fields):
+    """Buffer one structured log record; it is shipped when a size or time threshold is hit."""
+    record = {"timestamp": datetime.now(timezone.utc).isoformat(), "kind": kind}
+    if message is not None:
+        record["message"] = message
+    record.update(fields)
+    line = json.dumps(record, default=str)
+
+    _buffer.append((kind, line))
+    _buffer_state["bytes"] += len(line)
+    if _buffer_state["oldest"] is None:
+        _buffer_state["oldest"] = time.monotonic()
+
+    if (
+        len(_buffer) >= LOG_FLUSH_MAX_RECORDS
+        or _buffer_state["bytes"] >= LOG_FLUSH_MAX_BYTES
+        or time.monotonic() - _buffer_state["oldest"] >= LOG_FLUSH_INTERVAL_SECONDS
+    ):
+        _schedule_flush()
+
+
+def log_error(error_log: str, **fields):
+    """Record an error message."""
+    print(error_log)
+    log_event("error", error_log, **fields)
+
+
+def log_processed_records(entity: str, successcount: int, failedcount: int, **fields):
+    """Record the outcome counts of a sync run."""
+    log_event("processed_records", entity=entity, success=successcount, failed=failedcount, **fields)
+
+
+async def _flush_periodically():
+    while True:
+        await asyncio.sleep(LOG_FLUSH_INTERVAL_SECONDS)
+        await flush()
+
+
+def start_log_sink():
+    """Start the background flush timer; called from the app lifespan."""
+    global _periodic_task
+    if _periodic_task is None or _periodic_task.done():
+        _periodic_task = asyncio.get_running_loop().create_task(_flush_periodically())
+
+
+async def stop_log_sink():
+    """Stop the flush timer and write whatever is still buffered."""
+    global _periodic_task
+    if _periodic_task is not None:
+        _periodic_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await _periodic_task
+        _periodic_task = None
+    if _flush_task is not None and not _flush_task.done():
+        await _flush_task
+    await flush()
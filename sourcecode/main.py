@@ -1,8 +1,74 @@
-from fastapi import FastAPI
-from sourcecode.routers import leads ,Accounts,contacts
-from mangum import Mangum
+import os
+from contextlib import asynccontextmanager
+from sourcecode.startupReport import measure, print_startup_report, startup_report
 
-app = FastAPI()
+with measure("fastapi"):
+    from fastapi import FastAPI
+    from fastapi.responses import JSONResponse, PlainTextResponse
+with measure("sourcecode.routers.leads"):
+    from sourcecode.routers import leads
+with measure("sourcecode.routers.Accounts"):
+    from sourcecode.routers import Accounts
+with measure("sourcecode.routers.contacts"):
+    from sourcecode.routers import contacts
+with measure("mangum"):
+    from mangum import Mangum
+
+from sourcecode.appConfig import get_config
+from sourcecode.crmAuthentication import authenticate_crm
+from sourcecode.httpClients import open_clients, close_clients
+from sourcecode.jsonCodec import dumps
+from sourcecode.logSink import start_log_sink, stop_log_sink
+from sourcecode.metrics import render_metrics
+
+# Load settings and a CRM token during startup instead of on the first request
+WARM_ON_STARTUP = os.getenv("WARM_ON_STARTUP", "false").lower() == "true"
+
+# Set by the Lambda runtime; Mangum runs the lifespan around every invocation there
+RUNNING_ON_LAMBDA = bool(os.getenv("AWS_LAMBDA_FUNCTION_NAME"))
+
+# Only the first lifespan of the process is a cold start; later ones are warm invocations
+_cold_start = True
+
+
+class CodecJSONResponse(JSONResponse):
+    """JSON responses rendered by the configured codec, like FastAPI's ORJSONResponse."""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _cold_start
+    cold_start, _cold_start = _cold_start, False
+
+    # Shared upstream connection pools live for the whole app
+    with measure("http clients", kind="init", record=cold_start):
+        open_clients()
+    start_log_sink()
+
+    if WARM_ON_STARTUP:
+        try:
+            with measure("settings", kind="init", record=cold_start):
+                get_config()
+            with measure("crm token", kind="init", record=cold_start):
+                await authenticate_crm()
+        except Exception as e:
+            # The first request will retry, so a failed warm-up must not stop the app
+            print(f"Startup warm-up failed: {e}")
+
+    if cold_start:
+        print_startup_report()
+    yield
+    await stop_log_sink()
+    # A warm container reuses the pooled connections (and the AIMD limits learned on them)
+    # in its next invocation, so only a real server shutdown closes the clients
+    if not RUNNING_ON_LAMBDA:
+        await close_clients()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=CodecJSONResponse)
 
 # Include the routers
 app.include_router(leads.router)
@@ -11,4 +77,18 @@ app.include_router(contacts.router, prefix="/contacts", tags=["contacts"])
 # app.include_router(contacts.router)
 # app.include_router(accounts.router)
 
+
+@app.get("/startup-report")
+async def get_startup_report():
+    """Cold-start import and init cost per phase."""
+    return startup_report()
+
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Pipeline stage, throughput and upstream metrics in the Prometheus text format."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 handler = Mangum(app)
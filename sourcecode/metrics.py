@@ -0,0 +1,161 @@
+import functools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# Latency buckets in seconds, from fast lookups up to slow full-window syncs
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_METRIC_HELP = {
+    "afi_stage_duration_seconds": ("histogram", "Duration of one pipeline stage call (token, page_fetch, metadata, lookup, mapping, moengage_post)."),
+    "afi_stage_errors_total": ("counter", "Pipeline stage calls that raised an error."),
+    "afi_records_total": ("counter", "Records processed by the MoEngage push stage, by outcome."),
+    "afi_sync_duration_seconds": ("histogram", "Duration of a full sync run."),
+    "afi_sync_records_per_second": ("gauge", "Throughput of the most recent sync run."),
+    "afi_upstream_requests_total": ("counter", "Upstream HTTP responses by status code."),
+    "afi_upstream_bytes_total": ("counter", "Bytes sent to (out) and received from (in) upstreams."),
+    "afi_upstream_retries_total": ("counter", "Upstream requests retried, by status code or error."),
+    "afi_upstream_concurrency_limit": ("gauge", "Current AIMD concurrency limit per upstream."),
+    "afi_request_budget_waiting": ("gauge", "Requests queued for the shared upstream request budget."),
+    "afi_request_budget_wait_seconds": ("histogram", "Time a queued request waited for the request budget."),
+    "afi_fetch_cache_requests_total": ("counter", "/fetch* requests by cache outcome (hit, miss, coalesced, not_modified)."),
+    "afi_fetch_cache_bytes": ("gauge", "Encoded /fetch* responses held in the response cache."),
+    "afi_sync_triggers_total": ("counter", "Sync triggers by outcome (started, joined, skipped while another run held the lock)."),
+}
+
+# (name, sorted label items) -> value, or histogram state for histograms
+_counters = {}
+_gauges = {}
+_histograms = {}
+
+# Entity (leads, contacts, accounts) the current request is working on
+_current_entity = ContextVar("afi_metrics_entity", default="none")
+_current_run = ContextVar("afi_metrics_run", default=None)
+
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc_counter(name: str, value: float = 1, **labels):
+    key = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels):
+    _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, **labels):
+    key = _key(name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = {"buckets": [0] * len(DEFAULT_BUCKETS), "sum": 0.0, "count": 0}
+    for index, bound in enumerate(DEFAULT_BUCKETS):
+        if value <= bound:
+            histogram["buckets"][index] += 1
+    histogram["sum"] += value
+    histogram["count"] += 1
+
+
+def current_entity():
+    return _current_entity.get()
+
+
+@contextmanager
+def timed(stage: str):
+    """Observe how long a pipeline stage takes for the current entity."""
+    entity = _current_entity.get()
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        inc_counter("afi_stage_errors_total", stage=stage, entity=entity)
+        raise
+    finally:
+        observe("afi_stage_duration_seconds", time.perf_counter() - started, stage=stage, entity=entity)
+
+
+def count_records(outcome: str, value: int):
+    """Count pushed records for the current entity and the sync run in progress."""
+    if not value:
+        return
+    inc_counter("afi_records_total", value, entity=_current_entity.get(), outcome=outcome)
+    run = _current_run.get()
+    if run is not None:
+        run["records"] += value
+
+
+def record_upstream_response(upstream: str, status_code: int, bytes_out: int, bytes_in: int):
+    inc_counter("afi_upstream_requests_total", upstream=upstream, status=str(status_code))
+    inc_counter("afi_upstream_bytes_total", bytes_out, upstream=upstream, direction="out")
+    inc_counter("afi_upstream_bytes_total", bytes_in, upstream=upstream, direction="in")
+
+
+def track_entity(entity: str):
+    """Decorator labelling every metric recorded by an endpoint with ``entity``."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = _current_entity.set(entity)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _current_entity.reset(token)
+        return wrapper
+    return decorator
+
+
+def track_sync(entity: str):
+    """Decorator for sync endpoints: labels metrics and records run duration and throughput."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            entity_token = _current_entity.set(entity)
+            run = {"records": 0}
+            run_token = _current_run.set(run)
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                observe("afi_sync_duration_seconds", elapsed, entity=entity)
+                set_gauge("afi_sync_records_per_second", run["records"] / elapsed if elapsed else 0.0, entity=entity)
+                _current_run.reset(run_token)
+                _current_entity.reset(entity_token)
+        return wrapper
+    return decorator
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in items) + "}"
+
+
+def render_metrics():
+    """Render every metric in the Prometheus text exposition format."""
+    lines = []
+    for name, (metric_type, help_text) in _METRIC_HELP.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        if metric_type == "counter":
+            for (metric_name, labels), value in sorted(_counters.items()):
+                if metric_name == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        elif metric_type == "gauge":
+            for (metric_name, labels), value in sorted(_gauges.items()):
+                if metric_name == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        else:
+            for (metric_name, labels), histogram in sorted(_histograms.items()):
+                if metric_name != name:
+                    continue
+                for bound, count in zip(DEFAULT_BUCKETS, histogram["buckets"]):
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
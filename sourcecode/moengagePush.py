@@ -0,0 +1,208 @@
+import asyncio
+import inspect
+import os
+from sourcecode.fingerprintStore import fingerprint_attributes, load_fingerprints, save_fingerprints
+from sourcecode.httpClients import get_moengage_client
+from sourcecode.jsonCodec import dumps
+from sourcecode.metrics import count_records, timed
+
+
+# Maximum number of MoEngage requests in flight at once
+MOENGAGE_MAX_IN_FLIGHT = int(os.getenv("MOENGAGE_MAX_IN_FLIGHT", "8"))
+
+# Limits for one batched transition request
+MOENGAGE_BATCH_MAX_ELEMENTS = int(os.getenv("MOENGAGE_BATCH_MAX_ELEMENTS", "200"))
+MOENGAGE_BATCH_MAX_BYTES = int(os.getenv("MOENGAGE_BATCH_MAX_BYTES", "120000"))
+
+# With change detection on, send only the attributes that changed since the last delivery
+MOENGAGE_SEND_CHANGED_ONLY = os.getenv("MOENGAGE_SEND_CHANGED_ONLY", "false").lower() == "true"
+
+# Rejections caused by the payload itself, where bisecting can isolate the bad customer.
+# 5xx, throttling and transport errors were already retried by the client and fail the whole batch.
+PAYLOAD_REJECTION_STATUS_CODES = frozenset({400, 413, 422})
+
+
+def build_batches(items, max_elements: int = None, max_bytes: int = None):
+    """Group mapped items into batches that fit the element and byte limits.
+
+    Each item is a dict holding the customer's ``elements`` and their encoded ``size``. A
+    customer's elements are never split across batches, so an oversized customer goes alone.
+    """
+    max_elements = max_elements or MOENGAGE_BATCH_MAX_ELEMENTS
+    max_bytes = max_bytes or MOENGAGE_BATCH_MAX_BYTES
+
+    batch = []
+    batch_elements = 0
+    batch_bytes = 0
+    for item in items:
+        item_elements = len(item["elements"])
+        if batch and (
+            batch_elements + item_elements > max_elements or batch_bytes + item["size"] > max_bytes
+        ):
+            yield batch
+            batch = []
+            batch_elements = 0
+            batch_bytes = 0
+        batch.append(item)
+        batch_elements += item_elements
+        batch_bytes += item["size"]
+    if batch:
+        yield batch
+
+
+def transition_payload(batch):
+    """Pack the elements of every customer in a batch into one transition request body."""
+    return {
+        "type": "transition",
+        "elements": [element for item in batch for element in item["elements"]],
+    }
+
+
+def _customer_element(elements):
+    for element in elements:
+        if element.get("type") == "customer":
+            return element
+    return None
+
+
+async def _skip_unchanged(items, fingerprint_entity: str, changed_only: bool, ignore=()):
+    """Drop items whose mapped attributes match the last delivered fingerprint.
+
+    Each remaining item gets its new ``fingerprint``; with ``changed_only`` the customer
+    element is trimmed to the attributes that changed, plus the ``ignore``d attributes,
+    which are not fingerprinted and always sent along. Returns ``(items, skipped)``.
+    """
+    for item in items:
+        customer = _customer_element(item["elements"])
+        if customer is not None and customer.get("customer_id"):
+            item["customer_id"] = customer["customer_id"]
+            item["fingerprint"] = fingerprint_attributes(customer.get("attributes") or {}, ignore)
+
+    previous = await load_fingerprints(fingerprint_entity, (item.get("customer_id") for item in items))
+
+    remaining = []
+    skipped = 0
+    for item in items:
+        known = previous.get(item.get("customer_id"))
+        if known is None:
+            remaining.append(item)
+            continue
+        digest, attribute_digests = item["fingerprint"]
+        if digest == known[0]:
+            skipped += 1
+            continue
+        if changed_only:
+            customer = _customer_element(item["elements"])
+            customer["attributes"] = {
+                name: value for name, value in customer["attributes"].items()
+                if name not in attribute_digests or known[1].get(name) != attribute_digests[name]
+            }
+            item["size"] = len(dumps(item["elements"]))
+        remaining.append(item)
+    return remaining, skipped
+
+
+async def push_records(records, mapper, url: str, headers: dict, label: str = "record", max_in_flight: int = None,
+                       fingerprint_entity: str = None, changed_only: bool = None, page_mapper=None,
+                       fingerprint_ignore=()):
+    """Map records and post them to MoEngage in batched transition requests.
+
+    ``mapper`` turns one CRM record into a single-customer transition payload and may be sync
+    or async. ``page_mapper``, when given, maps the whole page in one call instead; if it
+    raises, the page is mapped record by record with ``mapper`` so only the bad records
+    fail. Batches are sent by a bounded number of concurrent workers; a batch whose payload
+    is rejected (400, 413, 422) is split in half and retried until the failing customers
+    are isolated, while any other failure fails the whole batch. With
+    ``fingerprint_entity`` set, customers whose mapped attributes have not changed since the
+    last successful delivery are skipped; attributes in ``fingerprint_ignore`` do not count
+    as changes. Returns the per-record ``success``, ``failed`` and
+    ``skipped`` counts plus the ``failed_records`` themselves.
+    """
+    client = get_moengage_client()
+    counts = {"success": 0, "failed": 0, "skipped": 0, "failed_records": []}
+    delivered = {}
+
+    items = []
+    with timed("mapping"):
+        mapped = None
+        if page_mapper is not None:
+            try:
+                mapped = list(zip(records, page_mapper(records)))
+            except Exception as e:
+                print(f"Failed to map the {label} page in one pass, mapping records one by one: {e}")
+
+        if mapped is None:
+            mapped = []
+            for record in records:
+                try:
+                    payload = mapper(record)
+                    if inspect.isawaitable(payload):
+                        payload = await payload
+                except Exception as e:
+                    counts["failed"] += 1
+                    counts["failed_records"].append(record)
+                    print(f"Failed to map {label} {record.get('emailaddress1')}: {e}")
+                    continue
+                mapped.append((record, payload))
+
+        for record, payload in mapped:
+            elements = payload["elements"]
+            items.append({
+                "record": record,
+                "identifier": record.get("emailaddress1"),
+                "elements": elements,
+                "size": len(dumps(elements)),
+            })
+
+    if fingerprint_entity:
+        if changed_only is None:
+            changed_only = MOENGAGE_SEND_CHANGED_ONLY
+        items, counts["skipped"] = await _skip_unchanged(items, fingerprint_entity, changed_only, fingerprint_ignore)
+
+    async def send_batch(batch):
+        try:
+            with timed("moengage_post"):
+                response = await client.post(
+                    url, content=dumps(transition_payload(batch)), headers={"Content-Type": "application/json", **headers},
+                )
+            ok = response.status_code == 200
+            rejected = response.status_code in PAYLOAD_REJECTION_STATUS_CODES
+            error = None if ok else f"{response.status_code} - {response.text}"
+        except Exception as e:
+            ok = rejected = False
+            error = str(e)
+
+        if ok:
+            counts["success"] += len(batch)
+            for item in batch:
+                if "fingerprint" in item:
+                    delivered[item["customer_id"]] = item["fingerprint"]
+            print(f"Sent batch of {len(batch)} {label}(s) successfully")
+        elif rejected and len(batch) > 1:
+            # Bisect so one bad customer does not fail the whole batch
+            middle = len(batch) // 2
+            await send_batch(batch[:middle])
+            await send_batch(batch[middle:])
+        else:
+            counts["failed"] += len(batch)
+            counts["failed_records"].extend(item["record"] for item in batch)
+            if len(batch) == 1:
+                print(f"Failed to send {label} {batch[0]['identifier']}: {error}")
+            else:
+                print(f"Failed to send batch of {len(batch)} {label}(s): {error}")
+
+    pending = build_batches(items)
+
+    async def worker():
+        # Workers share one batch generator, so at most max_in_flight requests are in flight
+        for batch in pending:
+            await send_batch(batch)
+
+    workers = max(1, max_in_flight or MOENGAGE_MAX_IN_FLIGHT)
+    await asyncio.gather(*(worker() for _ in range(workers)))
+
+    if fingerprint_entity:
+        await save_fingerprints(fingerprint_entity, delivered)
+    for outcome in ("success", "failed", "skipped"):
+        count_records(outcome, counts[outcome])
+    return counts
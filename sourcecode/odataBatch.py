@@ -0,0 +1,170 @@
+import asyncio
+import os
+import re
+import uuid
+
+import httpx
+from sourcecode.crmAuthentication import reauthenticated_headers
+from sourcecode.httpClients import get_dynamics_client
+
+
+# Group independent Dynamics GETs into one $batch request; "false" sends each GET on its own
+ODATA_BATCH_ENABLED = os.getenv("ODATA_BATCH_ENABLED", "true").lower() == "true"
+
+# Requests per $batch (Dataverse accepts up to 1000)
+ODATA_BATCH_MAX_REQUESTS = int(os.getenv("ODATA_BATCH_MAX_REQUESTS", "100"))
+
+# How long to collect GETs before sending; 0 batches the GETs issued in the same event loop step
+ODATA_BATCH_WINDOW_SECONDS = float(os.getenv("ODATA_BATCH_WINDOW_SECONDS", "0"))
+
+# Headers that belong to the outer $batch request rather than to each part
+_BATCH_LEVEL_HEADERS = {"authorization", "content-type", "content-length"}
+
+_BOUNDARY_PATTERN = re.compile(r'boundary="?([^";]+)"?')
+
+# (service root, Authorization) -> [(url, headers, future)] waiting to be sent
+_pending = {}
+_flush_handles = {}
+# Batches being sent, referenced so the tasks are not garbage collected mid-flight
+_sending = set()
+
+
+def _service_root(url: str):
+    """``https://org.crm.dynamics.com/api/data/v9.0/leads?...`` -> ``https://org.crm.dynamics.com/api/data/v9.0``"""
+    head, separator, rest = url.partition("/api/data/")
+    return f"{head}{separator}{rest.split('/', 1)[0]}"
+
+
+def build_batch_body(requests, boundary: str):
+    """Encode ``(url, headers)`` GET requests as a ``multipart/mixed`` $batch body."""
+    lines = []
+    for url, headers in requests:
+        lines += [
+            f"--{boundary}",
+            "Content-Type: application/http",
+            "Content-Transfer-Encoding: binary",
+            "",
+            f"GET {httpx.URL(url)} HTTP/1.1",
+            "Accept: application/json",
+        ]
+        lines += [f"{name}: {value}" for name, value in headers.items() if name.lower() not in _BATCH_LEVEL_HEADERS]
+        lines += ["", ""]
+    lines.append(f"--{boundary}--")
+    return ("\r\n".join(lines) + "\r\n").encode("utf-8")
+
+
+def parse_batch_response(content: bytes, content_type: str, urls):
+    """Split a $batch ``multipart/mixed`` response into one ``httpx.Response`` per request.
+
+    ``urls`` are the batched request URLs in order; each response is attached to a GET
+    request for its URL so ``raise_for_status`` and error messages work as for a plain GET.
+    """
+    match = _BOUNDARY_PATTERN.search(content_type)
+    if not match:
+        raise ValueError(f"$batch response has no multipart boundary: {content_type}")
+    text = content.decode("utf-8").replace("\r\n", "\n")
+
+    responses = []
+    for part in text.split(f"--{match.group(1)}")[1:]:
+        if part.startswith("--"):
+            break
+        # Skip the MIME part headers, then read the embedded HTTP response
+        _, _, message = part.lstrip("\n").partition("\n\n")
+        head, _, body = message.partition("\n\n")
+        status_line, *header_lines = head.split("\n")
+        headers = [tuple(item.strip() for item in line.split(":", 1)) for line in header_lines if ":" in line]
+        url = urls[len(responses)] if len(responses) < len(urls) else ""
+        responses.append(httpx.Response(
+            int(status_line.split(" ")[1]),
+            headers=headers,
+            content=body.rstrip("\n").encode("utf-8"),
+            request=httpx.Request("GET", url),
+        ))
+
+    if len(responses) != len(urls):
+        raise ValueError(f"$batch returned {len(responses)} responses for {len(urls)} requests")
+    return responses
+
+
+async def _send(key, items):
+    service_root, authorization = key
+    client = get_dynamics_client()
+    try:
+        if len(items) == 1:
+            url, headers, future = items[0]
+            response = await client.get(url, headers=headers)
+            if not future.done():
+                future.set_result(response)
+            return
+
+        boundary = f"batch_{uuid.uuid4().hex}"
+        batch_headers = {
+            "Content-Type": f"multipart/mixed; boundary={boundary}",
+            "Accept": "application/json",
+            "OData-MaxVersion": "4.0",
+            "OData-Version": "4.0",
+        }
+        if authorization:
+            batch_headers["Authorization"] = authorization
+        response = await client.post(
+            f"{service_root}/$batch",
+            content=build_batch_body([(url, headers) for url, headers, _ in items], boundary),
+            headers=batch_headers,
+        )
+        if response.status_code != 200:
+            # The batch as a whole was rejected: every caller sees that response
+            results = [response] * len(items)
+        else:
+            results = parse_batch_response(response.content, response.headers.get("Content-Type", ""), [url for url, _, _ in items])
+        for (_, _, future), result in zip(items, results):
+            if not future.done():
+                future.set_result(result)
+    except Exception as e:
+        for _, _, future in items:
+            if not future.done():
+                future.set_exception(e)
+
+
+def _flush(key):
+    _flush_handles.pop(key, None)
+    items = _pending.pop(key, [])
+    if items:
+        task = asyncio.ensure_future(_send(key, items))
+        _sending.add(task)
+        task.add_done_callback(_sending.discard)
+
+
+async def batched_get(url: str, headers: dict):
+    """GET a Dynamics Web API URL, sharing one ``$batch`` round trip with concurrent callers.
+
+    Calls made together (e.g. under ``asyncio.gather``) are sent as a single batch of up to
+    ``ODATA_BATCH_MAX_REQUESTS`` requests; each caller gets its own ``httpx.Response``. A
+    401 is retried once with a new token.
+    """
+    response = await _get(url, headers)
+    if response.status_code == 401 and headers.get("Authorization"):
+        # The token was revoked or expired before its stated lifetime: get a new one
+        response = await _get(url, await reauthenticated_headers(headers))
+    return response
+
+
+async def _get(url: str, headers: dict):
+    if not ODATA_BATCH_ENABLED:
+        return await get_dynamics_client().get(url, headers=headers)
+
+    loop = asyncio.get_running_loop()
+    key = (_service_root(url), headers.get("Authorization"))
+    future = loop.create_future()
+    _pending.setdefault(key, []).append((url, headers, future))
+
+    if len(_pending[key]) >= ODATA_BATCH_MAX_REQUESTS:
+        handle = _flush_handles.pop(key, None)
+        if handle is not None:
+            handle.cancel()
+        _flush(key)
+    elif key not in _flush_handles:
+        if ODATA_BATCH_WINDOW_SECONDS > 0:
+            _flush_handles[key] = loop.call_later(ODATA_BATCH_WINDOW_SECONDS, _flush, key)
+        else:
+            _flush_handles[key] = loop.call_soon(_flush, key)
+    return await future
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import os
+import time
+from sourcecode.metrics import timed
+from sourcecode.syncCheckpoint import load_checkpoint, save_checkpoint
+
+
+# How long a cached option set is trusted before it is downloaded again
+OPTIONSET_TTL_SECONDS = int(os.getenv("OPTIONSET_TTL_SECONDS", "3600"))
+
+# Checkpoint holding the labels, so a cold start (another Lambda container included) can
+# reuse the labels fetched by an earlier invocation; stored in S3 or SQLite like the watermarks
+OPTIONSET_SNAPSHOT_KEY = "optionsets"
+
+# (entity, attribute) -> {"fetched_at": epoch seconds, "labels": {value: label}}
+_option_sets = {}
+_snapshot_loaded = False
+
+
+def _cache_key(entity: str, attribute: str):
+    return f"{entity}|{attribute}"
+
+
+async def _load_snapshot():
+    """Populate the in-memory cache from the snapshot checkpoint once per process."""
+    global _snapshot_loaded
+    if _snapshot_loaded:
+        return
+
+    try:
+        snapshot = await load_checkpoint(OPTIONSET_SNAPSHOT_KEY)
+        snapshot = json.loads(snapshot) if snapshot else {}
+    except Exception as e:
+        print(f"Ignoring unreadable option set snapshot: {e}")
+        snapshot = {}
+    _snapshot_loaded = True
+
+    for key, entry in snapshot.items():
+        # JSON object keys are strings, so labels are stored as [value, label] pairs
+        _option_sets.setdefault(key, {
+            "fetched_at": entry["fetched_at"],
+            "labels": {value: label for value, label in entry["labels"]},
+        })
+
+
+async def _save_snapshot():
+    """Write the current cache to the snapshot checkpoint; failures are logged and ignored."""
+    snapshot = {
+        key: {"fetched_at": entry["fetched_at"], "labels": list(entry["labels"].items())}
+        for key, entry in _option_sets.items()
+    }
+    try:
+        await save_checkpoint(OPTIONSET_SNAPSHOT_KEY, json.dumps(snapshot))
+    except Exception as e:
+        print(f"Failed to write option set snapshot: {e}")
+
+
+def _is_fresh(entry):
+    return entry is not None and time.time() - entry["fetched_at"] < OPTIONSET_TTL_SECONDS
+
+
+def get_labels(entity: str, attribute: str):
+    """Return the cached value-to-label dict for an option set, or None if it is missing or stale."""
+    entry = _option_sets.get(_cache_key(entity, attribute))
+    return entry["labels"] if _is_fresh(entry) else None
+
+
+async def warm_option_sets(entity: str, loaders: dict):
+    """Make sure every option set of an entity is cached, fetching only missing or stale ones.
+
+    ``loaders`` maps an attribute logical name to the async metadata fetcher for it. The
+    fetcher must return a dict with an ``options`` list of ``{"value", "label"}`` items.
+    """
+    await _load_snapshot()
+    stale = [
+        attribute for attribute in loaders
+        if not _is_fresh(_option_sets.get(_cache_key(entity, attribute)))
+    ]
+    if not stale:
+        return
+
+    with timed("metadata"):
+        responses = await asyncio.gather(*(loaders[attribute](attribute) for attribute in stale))
+    fetched_at = time.time()
+    for attribute, response in zip(stale, responses):
+        _option_sets[_cache_key(entity, attribute)] = {
+            "fetched_at": fetched_at,
+            "labels": {option["value"]: option["label"] for option in response["options"]},
+        }
+    print(f"Refreshed {entity} option sets: {', '.join(stale)}")
+    await _save_snapshot()
+
+
+async def get_option_labels(entity: str, attribute: str, loader):
+    """Return the value-to-label dict for one option set, revalidating it when the TTL has passed."""
+    await _load_snapshot()
+    labels = get_labels(entity, attribute)
+    if labels is None:
+        await warm_option_sets(entity, {attribute: loader})
+        labels = _option_sets[_cache_key(entity, attribute)]["labels"]
+    return labels
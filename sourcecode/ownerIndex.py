@@ -0,0 +1,36 @@
+import os
+from collections import OrderedDict
+
+
+# Maximum number of owner ids kept in memory; least recently used entries are evicted first
+OWNER_INDEX_MAX_SIZE = int(os.getenv("OWNER_INDEX_MAX_SIZE", "5000"))
+
+# systemuserid -> internalemailaddress (None when the user has no email), shared across runs
+_owner_emails = OrderedDict()
+
+
+def get_owner_email(owner_id: str):
+    """Return the cached email of an owner and mark it as recently used."""
+    if owner_id not in _owner_emails:
+        return None
+    _owner_emails.move_to_end(owner_id)
+    return _owner_emails[owner_id]
+
+
+def remember_owner_email(owner_id: str, email):
+    """Store an owner's email, evicting the least recently used entry if the index is full."""
+    _owner_emails[owner_id] = email
+    _owner_emails.move_to_end(owner_id)
+    while len(_owner_emails) > OWNER_INDEX_MAX_SIZE:
+        _owner_emails.popitem(last=False)
+
+
+def missing_owner_ids(owner_ids):
+    """Return the distinct owner ids that are not in the index yet, preserving order."""
+    seen = set()
+    missing = []
+    for owner_id in owner_ids:
+        if owner_id and owner_id not in seen and owner_id not in _owner_emails:
+            seen.add(owner_id)
+            missing.append(owner_id)
+    return missing
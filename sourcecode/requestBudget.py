@@ -0,0 +1,106 @@
+"""Client-side request budget for the Dynamics Web API.
+
+The budget and its priority queue live in this process only. Concurrent Lambda containers
+or uvicorn workers each get their own bucket, so together they can exceed
+``DYNAMICS_REQUESTS_PER_SECOND`` and priorities only order the requests of one process;
+set the rate per process accordingly (e.g. the service limit divided by the expected
+concurrency). Dataverse still answers excess requests with 429, which ``resilience``
+retries.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from sourcecode.metrics import current_entity, observe, set_gauge
+
+
+# Dataverse allows 6000 requests per user per 5 minutes; every router shares one principal
+DYNAMICS_REQUESTS_PER_SECOND = float(os.getenv("DYNAMICS_REQUESTS_PER_SECOND", "20"))
+DYNAMICS_REQUEST_BURST = int(os.getenv("DYNAMICS_REQUEST_BURST", "50"))
+
+# Lower rank is served first, e.g. "leads=0,contacts=1,accounts=2"; unlisted callers get rank 0
+DYNAMICS_REQUEST_PRIORITIES = os.getenv("DYNAMICS_REQUEST_PRIORITIES", "leads=0,contacts=1,accounts=2")
+
+# Each rank counts as this many seconds of extra queueing, so low priorities are delayed, never starved
+REQUEST_BUDGET_PRIORITY_DELAY = float(os.getenv("REQUEST_BUDGET_PRIORITY_DELAY", "2"))
+
+
+def parse_priorities(value: str):
+    """Parse ``"leads=0,contacts=1"`` into ``{"leads": 0, "contacts": 1}``."""
+    priorities = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, rank = item.split("=", 1)
+            priorities[name.strip()] = int(rank)
+    return priorities
+
+
+class RequestBudget:
+    """Token bucket shared by every caller of one upstream, granting requests by priority.
+
+    Tokens refill at ``rate`` per second up to ``burst``. Callers that find the bucket empty
+    queue with a deadline of their arrival time plus ``rank * priority_delay``; the earliest
+    deadline is served first, so higher-priority work overtakes queued bulk work while
+    bulk work still gets through once it has waited long enough.
+    """
+
+    def __init__(self, name: str, rate: float = None, burst: int = None, priorities: dict = None,
+                 priority_delay: float = None):
+        self.name = name
+        self.rate = DYNAMICS_REQUESTS_PER_SECOND if rate is None else rate
+        self.burst = DYNAMICS_REQUEST_BURST if burst is None else burst
+        self.priorities = parse_priorities(DYNAMICS_REQUEST_PRIORITIES) if priorities is None else priorities
+        self.priority_delay = REQUEST_BUDGET_PRIORITY_DELAY if priority_delay is None else priority_delay
+        self.tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._dispatcher = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(float(self.burst), self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, caller: str = None):
+        """Wait for one request slot; ``caller`` defaults to the entity of the current request."""
+        caller = caller or current_entity()
+        self._refill()
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        deadline = started + self.priorities.get(caller, 0) * self.priority_delay
+        heapq.heappush(self._waiters, (deadline, next(self._sequence), future))
+        set_gauge("afi_request_budget_waiting", len(self._waiters), upstream=self.name)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        await future
+        observe("afi_request_budget_wait_seconds", time.monotonic() - started, upstream=self.name, entity=caller)
+
+    async def _dispatch(self):
+        while self._waiters:
+            self._refill()
+            while self._waiters and self.tokens >= 1:
+                _, _, future = heapq.heappop(self._waiters)
+                # Skip callers that were cancelled while queued
+                if not future.done():
+                    self.tokens -= 1
+                    future.set_result(None)
+            set_gauge("afi_request_budget_waiting", len(self._waiters), upstream=self.name)
+            if self._waiters:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+_dynamics_budget = None
+
+
+def get_dynamics_budget():
+    """The process-wide request budget for the Dynamics Web API."""
+    global _dynamics_budget
+    if _dynamics_budget is None:
+        _dynamics_budget = RequestBudget("dynamics")
+    return _dynamics_budget
@@ -0,0 +1,181 @@
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import httpx
+from sourcecode.metrics import inc_counter, set_gauge
+
+
+# Attempts per request, including the first one
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+
+# Exponential backoff bounds in seconds; the actual delay is jittered between 0 and the bound
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "30"))
+
+# Give up instead of sleeping when the upstream asks us to wait longer than this
+RETRY_MAX_RETRY_AFTER = float(os.getenv("RETRY_MAX_RETRY_AFTER", "120"))
+
+# Concurrency window per upstream: starts at the initial limit and moves between min and max
+AIMD_INITIAL_LIMIT = int(os.getenv("AIMD_INITIAL_LIMIT", "4"))
+AIMD_MIN_LIMIT = int(os.getenv("AIMD_MIN_LIMIT", "1"))
+AIMD_MAX_LIMIT = int(os.getenv("AIMD_MAX_LIMIT", "20"))
+AIMD_DECREASE_FACTOR = float(os.getenv("AIMD_DECREASE_FACTOR", "0.5"))
+# A burst of throttled responses shrinks the window once, not once per response
+AIMD_DECREASE_COOLDOWN = float(os.getenv("AIMD_DECREASE_COOLDOWN", "1"))
+
+# Responses worth another attempt; 429 and 503 also mean the upstream is throttling us
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+THROTTLE_STATUS_CODES = frozenset({429, 503})
+
+
+def backoff_delay(attempt: int, base: float = None, maximum: float = None):
+    """Full-jitter exponential backoff for the given 1-based attempt number."""
+    base = RETRY_BASE_DELAY if base is None else base
+    maximum = RETRY_MAX_DELAY if maximum is None else maximum
+    return random.uniform(0, min(maximum, base * 2 ** (attempt - 1)))
+
+
+def retry_after_seconds(response: httpx.Response):
+    """Seconds requested by a ``Retry-After`` header (delta-seconds or HTTP date), or None."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return max(0.0, (moment - datetime.now(timezone.utc)).total_seconds())
+
+
+class AimdLimiter:
+    """Additive-increase/multiplicative-decrease limit on concurrent requests to one upstream.
+
+    Every successful response widens the window by about one request per window's worth of
+    completions; a throttled response or timeout multiplies it by ``decrease_factor``.
+    """
+
+    def __init__(self, name: str, initial: int = None, minimum: int = None, maximum: int = None,
+                 decrease_factor: float = None, cooldown: float = None):
+        self.name = name
+        self.minimum = AIMD_MIN_LIMIT if minimum is None else minimum
+        self.maximum = AIMD_MAX_LIMIT if maximum is None else maximum
+        self.decrease_factor = AIMD_DECREASE_FACTOR if decrease_factor is None else decrease_factor
+        self.cooldown = AIMD_DECREASE_COOLDOWN if cooldown is None else cooldown
+        initial = AIMD_INITIAL_LIMIT if initial is None else initial
+        self.limit = float(min(self.maximum, max(self.minimum, initial)))
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = None
+
+    def _get_condition(self):
+        # Created on first use so the limiter binds to the loop that actually runs the requests
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self):
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, throttled: bool = False, adjust: bool = True):
+        """Free a slot; ``adjust=False`` leaves the window alone (cancelled or inconclusive requests)."""
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            if not adjust:
+                pass
+            elif throttled:
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self._last_decrease = now
+                    self.limit = max(float(self.minimum), self.limit * self.decrease_factor)
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            set_gauge("afi_upstream_concurrency_limit", int(self.limit), upstream=self.name)
+            condition.notify_all()
+
+
+class ResilientTransport(httpx.AsyncBaseTransport):
+    """httpx transport that retries throttled and failed requests under an AIMD concurrency limit.
+
+    Retryable responses (429, 5xx) and transport errors are retried up to ``max_attempts``
+    times, waiting for ``Retry-After`` when the upstream sends one and for jittered
+    exponential backoff otherwise. The last response is returned, or the last error
+    raised, once attempts run out. With a ``budget`` (see ``requestBudget``), every attempt
+    first waits for a slot of the shared request budget; ``budget_applies(request)`` limits
+    that to the requests the budget is meant for.
+    """
+
+    def __init__(self, upstream: str, transport: httpx.AsyncBaseTransport, limiter: AimdLimiter = None,
+                 max_attempts: int = None, budget=None, budget_applies=None):
+        self.upstream = upstream
+        self._transport = transport
+        self.limiter = limiter or AimdLimiter(upstream)
+        self.budget = budget
+        self.budget_applies = budget_applies
+        self.max_attempts = max(1, RETRY_MAX_ATTEMPTS if max_attempts is None else max_attempts)
+
+    async def handle_async_request(self, request: httpx.Request):
+        budget = self.budget
+        if budget is not None and self.budget_applies is not None and not self.budget_applies(request):
+            budget = None
+        attempt = 0
+        while True:
+            attempt += 1
+            if budget is not None:
+                await budget.acquire()
+            await self.limiter.acquire()
+            # Every exit releases the slot, including protocol errors and cancellation; only a
+            # response or a timeout says anything about upstream capacity
+            throttled = False
+            adjust = False
+            try:
+                response = await self._transport.handle_async_request(request)
+                throttled = response.status_code in THROTTLE_STATUS_CODES
+                adjust = True
+            except httpx.TransportError as e:
+                if isinstance(e, httpx.TimeoutException):
+                    throttled = adjust = True
+                if attempt >= self.max_attempts:
+                    raise
+                delay = backoff_delay(attempt)
+                self._log_retry(request, type(e).__name__, attempt, delay)
+                response = None
+            finally:
+                await self.limiter.release(throttled=throttled, adjust=adjust)
+
+            if response is None:
+                await asyncio.sleep(delay)
+                continue
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt >= self.max_attempts:
+                return response
+
+            delay = retry_after_seconds(response)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            elif delay > RETRY_MAX_RETRY_AFTER:
+                # Waiting that long would outlive the invocation; let the caller handle it
+                return response
+            await response.aclose()
+            self._log_retry(request, str(response.status_code), attempt, delay)
+            await asyncio.sleep(delay)
+
+    def _log_retry(self, request: httpx.Request, reason: str, attempt: int, delay: float):
+        inc_counter("afi_upstream_retries_total", upstream=self.upstream, reason=reason)
+        print(f"Retrying {self.upstream} {request.method} {request.url.path} after {reason} "
+              f"in {delay:.2f}s (attempt {attempt + 1}/{self.max_attempts})")
+
+    async def aclose(self):
+        await self._transport.aclose()
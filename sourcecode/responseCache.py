@@ -0,0 +1,115 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from fastapi import Response
+from sourcecode.jsonCodec import dumps
+from sourcecode.metrics import current_entity, inc_counter, set_gauge
+from sourcecode.sharedTask import start_shared_task
+from sourcecode.syncCheckpoint import format_odata_datetime
+
+
+# How long a /fetch* response is served from memory; 0 turns the cache off
+FETCH_CACHE_TTL_SECONDS = int(os.getenv("FETCH_CACHE_TTL_SECONDS", "60"))
+
+# Upper bound on the encoded responses kept in memory; least recently used entries go first
+FETCH_CACHE_MAX_BYTES = int(os.getenv("FETCH_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+_EPOCH = datetime(1970, 1, 1)
+
+# key -> {"body": encoded JSON, "etag": quoted digest, "expires_at": monotonic seconds}
+_entries = OrderedDict()
+_size = 0
+# key -> task building that response, shared by every concurrent request for the key
+_in_flight = {}
+
+
+def cached_window_start(lookback):
+    """Start of a window of ``lookback`` ending now, as an OData timestamp.
+
+    The start is rounded down to a multiple of the cache TTL, so requests made within
+    the same TTL period ask for the same window and share one cache entry.
+    """
+    moment = datetime.utcnow() - lookback
+    if FETCH_CACHE_TTL_SECONDS > 0:
+        seconds = int((moment - _EPOCH).total_seconds())
+        moment = _EPOCH + timedelta(seconds=seconds - seconds % FETCH_CACHE_TTL_SECONDS)
+    return format_odata_datetime(moment)
+
+
+def _etag(body: bytes):
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def _matches(if_none_match: str, etag: str):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    tags = (tag.strip() for tag in if_none_match.split(","))
+    return etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+def _evict(key):
+    global _size
+    entry = _entries.pop(key, None)
+    if entry is not None:
+        _size -= len(entry["body"])
+
+
+def _store(key, entry):
+    global _size
+    _evict(key)
+    if len(entry["body"]) > FETCH_CACHE_MAX_BYTES:
+        return
+    now = time.monotonic()
+    for stale in [stale for stale, cached in _entries.items() if cached["expires_at"] <= now]:
+        _evict(stale)
+    _entries[key] = entry
+    _size += len(entry["body"])
+    while _size > FETCH_CACHE_MAX_BYTES:
+        _evict(next(iter(_entries)))
+    set_gauge("afi_fetch_cache_bytes", _size)
+
+
+async def _build(key, produce):
+    try:
+        body = dumps(await produce())
+        entry = {"body": body, "etag": _etag(body), "expires_at": time.monotonic() + FETCH_CACHE_TTL_SECONDS}
+        if FETCH_CACHE_TTL_SECONDS > 0:
+            _store(key, entry)
+        return entry
+    finally:
+        _in_flight.pop(key, None)
+
+
+async def cached_json_response(key, produce, if_none_match: str = None):
+    """Serve the JSON document built by ``produce`` for ``key`` from a short-lived cache.
+
+    ``produce`` is an async callable returning the document. A fresh cached entry is served
+    without calling it; concurrent requests for a key that is being built wait for that
+    one build instead of starting their own. Responses carry an ``ETag``, and a matching
+    ``If-None-Match`` gets an empty 304. Failed builds are not cached.
+    """
+    entry = _entries.get(key)
+    if entry is not None and entry["expires_at"] > time.monotonic():
+        _entries.move_to_end(key)
+        outcome = "hit"
+    else:
+        task = _in_flight.get(key)
+        outcome = "coalesced" if task is not None else "miss"
+        if task is None:
+            task = _in_flight[key] = start_shared_task(_build(key, produce))
+        # Shielded so one caller disconnecting does not cancel the build for the others
+        entry = await asyncio.shield(task)
+
+    max_age = max(0, int(entry["expires_at"] - time.monotonic()))
+    headers = {"ETag": entry["etag"], "Cache-Control": f"private, max-age={max_age}"}
+    if _matches(if_none_match, entry["etag"]):
+        inc_counter("afi_fetch_cache_requests_total", entity=current_entity(), outcome="not_modified")
+        return Response(status_code=304, headers=headers)
+    inc_counter("afi_fetch_cache_requests_total", entity=current_entity(), outcome=outcome)
+    return Response(content=entry["body"], media_type="application/json", headers=headers)
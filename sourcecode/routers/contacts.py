@@ -1,201 +1,131 @@
-import requests
-from fastapi import APIRouter, HTTPException
-from sourcecode.crmAuthentication import authenticate_crm
-from datetime import datetime, timedelta
-import boto3
-import json,httpx
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sourcecode.appConfig import get_setting
+from sourcecode.crmPaging import CRM_FETCH_SHARDS, CRM_SYNC_MODE, Lookup, iter_window_pages, prefetch_pages, stream_ndjson, sync_changes, sync_window
+from sourcecode.fieldMapping import Column, EntityMapping, Related
+from sourcecode.logSink import log_error, log_processed_records
+from sourcecode.metrics import track_entity, track_sync
+from sourcecode.moengagePush import push_records
+from sourcecode.responseCache import cached_json_response, cached_window_start
+from sourcecode.runLock import single_flight
+from datetime import timedelta
 
 router = APIRouter()
 
-# Initialize the AWS Secrets Manager client
-secrets_client = boto3.client("secretsmanager")
-S3_BUCKET_NAME = "apierrorlog"
-
-
-def log_error(bucketname: str, error_log: str, key_prefix: str = "errorlogs/"):
-    try:
-        log_time = f"{key_prefix}{datetime.utcnow().strftime('%Y-%m-%d_%H-%M-%S')}_error.log"
-        s3 = boto3.client('s3')
-        s3.put_object(Body=error_log, Bucket=bucketname, Key=log_time)
-        print(f"Error logged to S3://{bucketname}/{log_time}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to log in S3 bucket. S3: {str(e)}")
-
-def get_secret(secret_name: str):
-    """Fetch secrets from AWS Secrets Manager."""
-    try:
-        response = secrets_client.get_secret_value(SecretId=secret_name)
-        if "SecretString" in response:
-            return json.loads(response["SecretString"])
-        elif "SecretBinary" in response:
-            return json.loads(response["SecretBinary"])
-    except Exception as e:
-        print(f"Error fetching secret: {e}")
-        raise HTTPException(status_code=404, detail="Secrets not found")
-
-# Load secrets
-secrets = get_secret("afi/crm/test")
-
-if secrets:
-    CRM_API_URL = secrets.get("CRM_API_URL", "")
-    CRM_TOKEN_URL = secrets.get("CRM_TOKEN_URL", "")
-    CRM_CLIENT_ID = secrets.get("CRM_CLIENT_ID", "")
-    CRM_CLIENT_SECRET = secrets.get("CRM_CLIENT_SECRET", "")
-    MOENGAGE_API_URL = secrets.get("MOENGAGE_API_URL", "")
-    moe_token = secrets.get("moe_token", "")
-else:
-    error_message=f"Check Scerets Manager Values"
-    log_error(S3_BUCKET_NAME,error_message)
-    raise HTTPException(status_code=500, detail="Failed to load secrets")
-
-
-
-
-
-
-# Authorization token for MoEngage
-token_moe = f"Basic {moe_token}"
-
-
+# Contact fields sent to MoEngage; the CRM $select/$expand are generated from this list
+CONTACT_MAPPING = EntityMapping("contact", [
+    Column("u_em", "emailaddress1"),
+    Column("u_mb", "mobilephone"),
+    Column("telephone1", "telephone1"),
+    Column("Created On", "createdon"),
+    Column("Modified On", "modifiedon"),
+    Column("new_contacttype", "new_contacttype"),
+    Related("_accountid_value", "parentcustomerid_account", "accountnumber", "No Account Number", lookup_field="_parentcustomerid_value"),
+    Related("_parentcustomerid_value", "parentcustomerid_account", "name", "No Account Name"),
+    Column("jobtitle", "jobtitle"),
+    Column("u_fn", "firstname"),
+    Column("u_ln", "lastname"),
+    Column("address1_city", "address1_city"),
+    Column("address1_line1", "address1_line1"),
+    Column("address1_line2", "address1_line2"),
+    Column("address1_line3", "address1_line3"),
+    Column("address1_postalcode", "address1_postalcode"),
+    Column("donotemail", "donotemail"),
+    Column("donotphone", "donotphone"),
+    Column("new_afiupliftemail", "new_afiupliftemail"),
+    Column("new_underbridgevanmountemail", "new_underbridgevanmountemail"),
+    Column("new_rapidemail", "new_rapidemail"),
+    Column("new_rentalsspecialoffers", "new_rentalsspecialoffers"),
+    Column("new_resaleemail", "new_resaleemail"),
+    Column("new_trackemail", "new_trackemail"),
+    Column("new_truckemail", "new_truckemail"),
+    Column("new_utnemail", "new_utnemail"),
+    Column("new_hoistsemail", "new_hoistsemail"),
+    Column("data8_tpsstatus", "data8_tpsstatus"),
+    Column("new_lastmewpscall", "new_lastmewpscall"),
+    Column("new_lastmewpscallwith", "new_lastmewpscallwith"),
+    Column("new_lastemailed", "new_lastemailed"),
+    Column("new_lastemailedby", "new_lastemailedby"),
+    Column("new_lastcalled", "new_lastcalled"),
+    Column("new_lastcalledby", "new_lastcalledby"),
+    Column("new_registerforupliftonline", "new_registerforupliftonline"),
+    Column("preferredcontactmethodcode", "preferredcontactmethodcode"),
+], volatile=("Modified On",))
+
+
+# Lookups resolved for change-tracking pages, which cannot $expand
+CONTACT_LOOKUPS = [Lookup("_parentcustomerid_value", "parentcustomerid_account", "accounts", "accountid")]
+
+
+def iter_contact_pages(since: str = None, shards: int = 1, fields=None):
+    """Yield pages of contacts modified since ``since`` (default: the last hour); see ``iter_window_pages``."""
+    return iter_window_pages("contacts", CONTACT_MAPPING, "modifiedon", since, shards, fields)
 
 
 @router.get("/fetch")
-async def fetch_contacts():
+@track_entity("contacts")
+async def fetch_contacts(shards: int = Query(CRM_FETCH_SHARDS, ge=1, le=32, description="Time slices fetched in parallel; 1 pages the window sequentially"),
+                         response_format: str = Query("json", alias="format", pattern="^(json|ndjson)$", description="json returns one object with every record; ndjson streams one record per line as pages arrive"),
+                         if_none_match: str = Header(None)):
     """Fetch contacts from Dynamics 365 CRM using the access token."""
     try:
-        token = await authenticate_crm()
-        if not token:
-            raise HTTPException(status_code=401, detail="Failed to retrieve access token")
+        # Quantized so repeated requests within the cache TTL share one entry
+        since = cached_window_start(timedelta(hours=1))
+        if response_format == "ndjson":
+            return StreamingResponse(await stream_ndjson(prefetch_pages(iter_contact_pages(since, shards)), "contacts"), media_type="application/x-ndjson")
 
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-         
-            }
-
-        query="emailaddress1,_accountid_value,_parentcustomerid_value,telephone1,mobilephone,jobtitle,firstname,address1_city,lastname,address1_line1,address1_line2,address1_line3,address1_postalcode,donotemail,donotphone,new_afiupliftemail,new_underbridgevanmountemail,new_rapidemail,new_rentalsspecialoffers,new_resaleemail,new_trackemail,new_truckemail,new_utnemail,new_hoistsemail,data8_tpsstatus,new_lastmewpscall,new_lastmewpscallwith,new_lastemailed,new_lastemailedby,new_lastcalled,new_lastcalledby,new_registerforupliftonline,createdon,preferredcontactmethodcode"       
-        period = (datetime.utcnow() - timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-        contacts_url = f"{CRM_API_URL}/api/data/v9.0/contacts?$filter=modifiedon ge {period}&$select={query}&$expand=parentcustomerid_account($select=accountnumber),parentcustomerid_account($select=name)"
-        all_contacts = []
-        print("just eneterd contacts")
-        while contacts_url:
-            response = requests.get(contacts_url, headers=headers)
-            if response.status_code == 200:
-                data = response.json()
-                all_contacts.extend(data.get("value", []))
-                contacts_url = data.get("@odata.nextLink")
-            else:
-                raise HTTPException(status_code=response.status_code, detail="Failed to fetch contacts from CRM.")
-        print("prinitng all contacts")
-        print(all_contacts)
-        return {"contacts": all_contacts}
+        async def collect():
+            # Collect every page of the window into one response
+            all_contacts = []
+            async for page in iter_contact_pages(since, shards):
+                all_contacts.extend(page)
+            return {"contacts": all_contacts}
+
+        return await cached_json_response(("contacts", since), collect, if_none_match)
 
     except Exception as e:
-        error_message = f"Failed to fetch leads: {response.status_code} - {response.text}"
-        log_error(S3_BUCKET_NAME, error_message)
+        error_message = f"Failed to fetch contacts: {str(e)}"
+        log_error(error_message)
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 
 def map_contact_to_moengage(contact):
-   
-    parent_contact=contact.get("parentcustomerid_account")
-    accountid_value = contact.get("parentcustomerid_account", {}).get("accountnumber", "No Account Number") if parent_contact  else None
-    parentcustomerid_value = contact.get("parentcustomerid_account", {}).get("name", "No Account Name") if parent_contact  else None
-    
-
-    attributes= {
-        # "u_n": contact.get("fullname"),
-        "u_em": contact.get("emailaddress1"),
-        "u_mb": contact.get("mobilephone"),
-        "telephone1": contact.get("telephone1"),
-        "Created On": contact.get("createdon"),
-        "Modified On": contact.get("modifiedon"),
-        "new_contacttype": contact.get("new_contacttype"),
-        "_accountid_value": accountid_value,
-        "_parentcustomerid_value": parentcustomerid_value,
-        "jobtitle": contact.get("jobtitle"),
-        "u_fn": contact.get("firstname"),
-        "u_ln": contact.get("lastname"),
-        "address1_city": contact.get("address1_city"),
-        "address1_line1": contact.get("address1_line1"),
-        "address1_line2": contact.get("address1_line2"),
-        "address1_line3": contact.get("address1_line3"),
-        "address1_postalcode": contact.get("address1_postalcode"),
-        "donotemail": contact.get("donotemail"),
-        "donotphone": contact.get("donotphone"),
-        "new_afiupliftemail": contact.get("new_afiupliftemail"),
-        "new_underbridgevanmountemail": contact.get("new_underbridgevanmountemail"),
-        "new_rapidemail": contact.get("new_rapidemail"),
-        "new_rentalsspecialoffers": contact.get("new_rentalsspecialoffers"),
-        "new_resaleemail": contact.get("new_resaleemail"),
-        "new_trackemail": contact.get("new_trackemail"),
-        "new_truckemail": contact.get("new_truckemail"),
-        "new_utnemail": contact.get("new_utnemail"),
-        "new_hoistsemail": contact.get("new_hoistsemail"),
-        "data8_tpsstatus": contact.get("data8_tpsstatus"),
-        "new_lastmewpscall": contact.get("new_lastmewpscall"),
-        "new_lastmewpscallwith": contact.get("new_lastmewpscallwith"),
-        "new_lastemailed": contact.get("new_lastemailed"),
-        "new_lastemailedby": contact.get("new_lastemailedby"),
-        "new_lastcalled": contact.get("new_lastcalled"),
-        "new_lastcalledby": contact.get("new_lastcalledby"),
-        "new_registerforupliftonline": contact.get("new_registerforupliftonline"),
-        "preferredcontactmethodcode": contact.get("preferredcontactmethodcode"),
-    }
-    print("printing attriutes")
-    # attributes['u_em']="jhon@example.com"
-    print(attributes)
-    customer_id=attributes.get("u_em")
-    print(customer_id)
-    final_payload={
-        "type": "transition",
-        "elements": [
-            {
-                "type": "customer",
-                "customer_id": customer_id,
-                "attributes": attributes,
-            },
-            {
-                "type": "event",
-                "customer_id": customer_id,
-                "actions": []  # Empty actions array as per your example
-            },
-        ],
-    }
-    print("printing final payload")
-    print(final_payload)
-    
-    return final_payload
+    """Map contact fields from CRM to MoEngage."""
+    return CONTACT_MAPPING.map_record(contact)
 
 
 @router.get("/sync")
-async def sync_contacts():
+@single_flight("contacts")
+@track_sync("contacts")
+async def sync_contacts(mode: str = Query(CRM_SYNC_MODE, pattern="^(window|delta)$", description="window (modifiedon filter) or delta (change tracking)"),
+                        shards: int = Query(CRM_FETCH_SHARDS, ge=1, le=32, description="Time slices fetched in parallel; 1 pages the window sequentially")):
     """Fetch contacts from CRM and send them to MoEngage."""
     try:
-        contacts_response = await fetch_contacts()
-        contacts = contacts_response.get("contacts", [])
-        print("printing token")
-        print(moe_token)
         headers = {
-            'Authorization': token_moe,
+            'Authorization': f"Basic {get_setting('moe_token')}",
             'Content-Type': 'application/json',
             'MOE-APPKEY':'6978DCU8W19J0XQOKS7NEE1C_DEBUG'
         }
 
-        # Send contacts to MoEngage
-        for contact in contacts:
-            payload = map_contact_to_moengage(contact)
-            print("printing payload")
-            print(payload)
-            response = requests.post(MOENGAGE_API_URL, json=payload, headers=headers)
-            if response.status_code == 200:
-                print(f"Contact sent successfully for {contact['emailaddress1']} ")
-            else:
-                print(f"Failed to send contact {contact['emailaddress1']}: {response.text}")
-
-        return {"status": "Contacts synchronized successfully"}
+        def push_page(contacts):
+            return push_records(contacts, map_contact_to_moengage, get_setting("MOENGAGE_API_URL"), headers, label="contact", fingerprint_entity="contacts", page_mapper=CONTACT_MAPPING.map_page, fingerprint_ignore=CONTACT_MAPPING.volatile)
+
+        if mode == "delta":
+            counts = await sync_changes("contacts", CONTACT_MAPPING, CONTACT_LOOKUPS, push_page)
+            print(f"Contacts sync finished: {counts['success']} sent, {counts['failed']} failed, {counts['skipped']} unchanged, {len(counts['deleted'])} deleted")
+            log_processed_records("contacts", counts["success"], counts["failed"], skipped=counts["skipped"], deleted=len(counts["deleted"]))
+            return {"status": "Contacts synchronized successfully", **counts}
+
+        # Send each page of contacts to MoEngage while the next one is being downloaded
+        counts = await sync_window("contacts", iter_contact_pages, push_page, "modifiedon", shards, fields=CONTACT_MAPPING.columns)
+        print(f"Contacts sync finished: {counts['success']} sent, {counts['failed']} failed, {counts['skipped']} unchanged")
+        log_processed_records("contacts", counts["success"], counts["failed"], skipped=counts["skipped"])
+
+        return {"status": "Contacts synchronized successfully", **counts}
     
 
 
     except Exception as e:
+        error_message = f"Error during sync-contacts: {str(e)}"
+        log_error(error_message)
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
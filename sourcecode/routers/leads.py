@@ -1,318 +1,125 @@
-import requests
-from fastapi import APIRouter, HTTPException,Query
+from fastapi import APIRouter, Header, HTTPException,Query
+from fastapi.responses import StreamingResponse
+from sourcecode.appConfig import get_setting
 from sourcecode.crmAuthentication import authenticate_crm
-from datetime import datetime, timedelta
-import boto3
-import json,httpx
-from botocore.config import Config
+from sourcecode.crmPaging import CRM_FETCH_SHARDS, iter_window_pages, prefetch_pages, stream_ndjson, sync_window
+from sourcecode.fieldMapping import Column, EntityMapping, OptionLabel, Related, Resolved
+from sourcecode.logSink import log_error, log_processed_records
+from sourcecode.metrics import timed, track_entity, track_sync
+from sourcecode.moengagePush import push_records
+from sourcecode.responseCache import cached_json_response, cached_window_start
+from sourcecode.runLock import single_flight
+from sourcecode.odataBatch import batched_get
+from sourcecode.optionSetCache import get_option_labels, warm_option_sets
+from sourcecode.ownerIndex import get_owner_email, missing_owner_ids, remember_owner_email
+from datetime import timedelta
+import asyncio,httpx
 
 router = APIRouter()
 
-# Initialize the AWS Secrets Manager client
-secrets_client = boto3.client("secretsmanager")
-
-S3_BUCKET_NAME = "apierrorlog"
-
-def get_secret(secret_name: str):
-    """Fetch secrets from AWS Secrets Manager."""
-    try:
-        response = secrets_client.get_secret_value(SecretId=secret_name)
-        if "SecretString" in response:
-            return json.loads(response["SecretString"])
-        elif "SecretBinary" in response:
-            return json.loads(response["SecretBinary"])
-    except Exception as e:
-        error_message=f"Error fetching Secrets from AWS:{str(e)}"
-        log_error(S3_BUCKET_NAME, error_message)
-        raise HTTPException(status_code=404, detail="Secrets not found")
-
-# Load secrets
-secrets = get_secret("afi/crm/test")
-
-if secrets:
-    CRM_API_URL = secrets.get("CRM_API_URL", "")
-    CRM_TOKEN_URL = secrets.get("CRM_TOKEN_URL", "")
-    CRM_CLIENT_ID = secrets.get("CRM_CLIENT_ID", "")
-    CRM_CLIENT_SECRET = secrets.get("CRM_CLIENT_SECRET", "")
-    MOENGAGE_API_URL = secrets.get("MOENGAGE_API_URL", "")
-    moe_token = secrets.get("moe_token", "")
-else:
-    raise HTTPException(status_code=500, detail="Failed to load secrets")
-
-# Authorization token for MoEngage
-token_moe = f"Basic {moe_token}"
-
-
-global_token=None
-
-def log_error(bucketname:str,error_log:str,key_prefix:str ="errorlogs/"):
-    
-    try:
-        log_time=f"{key_prefix}{datetime.utcnow().strftime('%Y-%m-%d_%H-%M-%S')}_error.log"
-        
-        
-        s3 = boto3.client('s3')
-        s3.put_object(Body=error_log, Bucket=bucketname, Key=log_time)
-
-        print(f"error logged to S3://{bucketname}/{log_time}")
-    
-    except Exception as e:
-        raise HTTPException(f"failed to log in s3 bucket.S3:{str(e)}")
-
-def log_processedRecords(bucketname:str,successcount:int,failedcount:int,count:int,key_prefix='processedRecords'):
-    try:
-        log_timestamp=f"{key_prefix}{datetime.utcnow().strftime('%Y-%m-%d_%H-%M-%S')}_record.log"
-        s3 = boto3.client('s3')
-        s3.put_object(Body=str(count), Bucket=S3_BUCKET_NAME, Key=log_timestamp)
-
-        print("records pushed to aws s3 bucket {bucketname}/{log_timestamp}")
-                      
-    except Exception as e:
-        raise HTTPException(status_code=500,details="Records count failed to log.")
-    
-
-
-
-def log_error(bucketname: str, error_log: str, key_prefix: str = "errorlogs/"):
-    try:
-        log_time = f"{key_prefix}{datetime.utcnow().strftime('%Y-%m-%d_%H-%M-%S')}_error.log"
-        s3 = boto3.client('s3', config=Config(retries={'max_attempts': 3, 'mode': 'standard'}))
-        
-        # Validate bucket existence
-        s3.head_bucket(Bucket=bucketname)
-
-        # Upload to S3
-        s3.put_object(Body=error_log, Bucket=bucketname, Key=log_time)
-        print(f"Error logged to S3://{bucketname}/{log_time}")
-
-    except boto3.exceptions.S3UploadFailedError as e:
-        raise HTTPException(status_code=500, detail=f"S3 upload failed: {str(e)}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Unexpected error during S3 logging: {str(e)}")
-
-def log_processedRecords(bucketname: str, successcount: int, failedcount: int, key_prefix='processedRecords/'):
-    try:
-        log_timestamp = f"{key_prefix}{datetime.utcnow().strftime('%Y-%m-%d_%H-%M-%S')}_record.log"
-        s3 = boto3.client('s3', config=Config(retries={'max_attempts': 3, 'mode': 'standard'}))
-
-        # Validate bucket existence
-        s3.head_bucket(Bucket=bucketname)
-
-        # Upload to S3
-        s3.put_object(Body=json.dumps({
-            "success": successcount,
-            "failed": failedcount,
-        }), Bucket=bucketname, Key=log_timestamp)
-        print(f"Records pushed to S3 bucket {bucketname}/{log_timestamp}")
-
-    except boto3.exceptions.S3UploadFailedError as e:
-        raise HTTPException(status_code=500, detail=f"S3 upload failed: {str(e)}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Unexpected error during S3 record logging: {str(e)}")
-
-
-
+# Lead fields sent to MoEngage; the CRM $select/$expand are generated from this list
+LEAD_MAPPING = EntityMapping("lead", [
+    Column("leadid", "leadid"),
+    Column("u_em", "emailaddress1"),
+    Column("u_mb", "mobilephone"),
+    Column("telephone1", "telephone1"),
+    Column("Company Name", "companyname"),
+    OptionLabel("Lead Type", "new_leadtype", "Unknown Lead Type"),
+    OptionLabel("Lead Source Code", "leadsourcecode", "Unknown Lead Source"),
+    OptionLabel("Status Code", "statuscode", "Unknown Status"),
+    Column("new_utm_campaign", "new_utm_campaign"),
+    Column("new_utm_campaignname", "new_utm_campaignname"),
+    Column("new_utm_content", "new_utm_content"),
+    Column("new_utm_source", "new_utm_source"),
+    Column("new_utm_medium", "new_utm_medium"),
+    Column("new_utm_term", "new_utm_term"),
+    Column("new_utm_keyword", "new_utm_keyword"),
+    Column("Created On", "createdon"),
+    Resolved("Owner", "_ownerid_value", get_owner_email),
+    Column("Topic", "subject"),
+    Related("Parent Contact Email", "parentcontactid", "emailaddress1", "No Contact Email", lookup_field="_parentcontactid_value"),
+    Related("Parent Account Number", "parentaccountid", "accountnumber", "No Account Number", lookup_field="_parentaccountid_value"),
+], device_id="96bd03b6-defc-4203-83d3-dc1c73080232")
+
+
+def iter_lead_pages(since: str = None, shards: int = 1, fields=None):
+    """Yield pages of leads created since ``since`` (default: the last hour); see ``iter_window_pages``."""
+    return iter_window_pages("leads", LEAD_MAPPING, "createdon", since, shards, fields)
 
 
 @router.get("/fetch-leads")
-async def fetch_leads():
-
-    global global_token
-
-
+@track_entity("leads")
+async def fetch_leads(shards: int = Query(CRM_FETCH_SHARDS, ge=1, le=32, description="Time slices fetched in parallel; 1 pages the window sequentially"),
+                      response_format: str = Query("json", alias="format", pattern="^(json|ndjson)$", description="json returns one object with every record; ndjson streams one record per line as pages arrive"),
+                      if_none_match: str = Header(None)):
     try:
-        # Authenticate and get the access token
-        token = await authenticate_crm()
-        global_token=token  # Ensure you're awaiting the async function
-        if not token:
-            raise HTTPException(status_code=401, detail="Failed to retrieve access token")
-        print(f"Token: {token}")
-
-        # Prepare the headers for the request
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-        }
-
-        # Get the current time and subtract one hour to get the time range
-        one_hour_ago = (datetime.utcnow() - timedelta(hours=1))
-
-        # Format the DateTimeOffset correctly for CRM API (including UTC timezone)
-        period = one_hour_ago.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'  # Exclude extra microseconds and add 'Z' for UTC
-
-        print(f"Formatted time: {period}")
-
-        # Set the API endpoint to fetch leads from Dynamics 365 CRM # top 5 is set up here for dev
-        leads_url = f"{CRM_API_URL}/api/data/v9.0/leads?$filter=createdon ge {period}&$select=lastname,new_afileadscore,_parentcontactid_value,_parentaccountid_value,companyname,mobilephone,telephone1,emailaddress1,new_leadtype,leadsourcecode,new_utm_campaign,new_utm_campaignname,new_utm_content,new_utm_source,new_utm_medium,new_utm_term,new_utm_keyword,createdon,_ownerid_value,statuscode,subject&$expand=parentcontactid($select=emailaddress1),parentaccountid($select=accountnumber)"
-
-        # Initialize an empty list to store leads
-        all_leads = []
-
-        # Fetch leads with pagination
-        while leads_url:
-            response = requests.get(leads_url, headers=headers)
-            
-            if response.status_code == 200:
-                data = response.json()
-                all_leads.extend(data.get("value", []))  # Add the leads to the list
-
-                leads_url = data.get("@odata.nextLink")
-                
-          
-                if leads_url:
-                    print(f"Fetching more leads from {leads_url}")
-            else:
-           
-                error_message = f"Failed to fetch leads: {response.status_code} - {response.text}"
-                log_error(S3_BUCKET_NAME, error_message)
-                raise HTTPException(status_code=response.status_code, detail="Failed to fetch leads from CRM.")
-        
-        # Return the aggregated leads
-        return {"leads": all_leads}
+        # Quantized so repeated requests within the cache TTL share one entry
+        since = cached_window_start(timedelta(hours=1))
+        if response_format == "ndjson":
+            return StreamingResponse(await stream_ndjson(prefetch_pages(iter_lead_pages(since, shards)), "leads"), media_type="application/x-ndjson")
+
+        async def collect():
+            # Collect every page of the window into one response
+            all_leads = []
+            async for page in iter_lead_pages(since, shards):
+                all_leads.extend(page)
+            return {"leads": all_leads}
+
+        return await cached_json_response(("leads", since), collect, if_none_match)
     
     except Exception as e:
         error_message = f"Error during fetch-leads: {str(e)}"
-        log_error(S3_BUCKET_NAME, error_message)
+        log_error(error_message)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
-async def map_lead_to_moengage(lead):
-    
-
-    new_leadtype_metadata_response = await fetch_metadata("new_leadtype")
-    new_leadtype_options = {
-        option["value"]: option["label"]
-        for option in new_leadtype_metadata_response["options"]
-    }
-
-    statuscode_metadata_response = await fetch_statuscode_metadata("statuscode")
-    statuscode_options = {
-        option["value"]: option["label"]
-        for option in statuscode_metadata_response["options"]
-    }
-
-    leadsourcecode_metadata_response = await fetch_leadsourcecode_metadata("leadsourcecode")
-    leadsourcecode_options = {
-        option["value"]: option["label"]
-        for option in leadsourcecode_metadata_response["options"]
+async def lead_option_labels():
+    """Option set labels used by the lead mapping, keyed by attribute, from the option set cache."""
+    return {
+        attribute: await get_option_labels("lead", attribute, LEAD_OPTION_SETS[attribute])
+        for attribute in LEAD_MAPPING.option_sets
     }
 
-    # Extract the fields from the lead and map them to the corresponding labels using metadata
-    lead_type = new_leadtype_options.get(lead.get("new_leadtype"), "Unknown Lead Type")
-    lead_source = leadsourcecode_options.get(lead.get("leadsourcecode"), "Unknown Lead Source")
-    lead_status = statuscode_options.get(lead.get("statuscode"), "Unknown Status")
-    print("calling parent account and contact id")
-    parent_contact=lead.get("parentcontactid")
-    parent_account=lead.get("parentaccountid")
-    parent_contact_email = lead.get("parentcontactid", {}).get("emailaddress1", "No Contact Email") if parent_contact  else None
-    parent_account_number = lead.get("parentaccountid", {}).get("accountnumber", "No Account Number") if parent_account  else None
-
-    print(parent_account_number,"\tseparater\t",parent_contact_email)
-
-    print("printing other attributes")
-    print(lead_type)
-    print(lead_status)
-    print(lead_status)
-
-    print("owner id")
-    email_data_response = await fetch_email_from_lead()
-    internal_email_address = email_data_response["internal_email_address"]
-    print("check email here\n")
-    print(internal_email_address)
-
-    payload = {
-        "leadid": lead.get("leadid"),
-        "u_em": lead.get("emailaddress1"),  
-        "u_mb": lead.get("mobilephone"),  
-        "telephone1": lead.get("telephone1"), 
-        "Company Name": lead.get("companyname" ),  # Company name
-        "Lead Type": lead_type,  # Use the mapped value
-        "Lead Source Code": lead_source,  # Use the mapped value
-        "Status Code": lead_status,  # Use the mapped value
-        "new_utm_campaign": lead.get("new_utm_campaign" ),  # UTM Campaign
-        "new_utm_campaignname": lead.get("new_utm_campaignname" ),  # UTM Campaign Name
-        "new_utm_content": lead.get("new_utm_content" ),  # UTM Content
-        "new_utm_source": lead.get("new_utm_source" ),  # UTM Source
-        "new_utm_medium": lead.get("new_utm_medium" ),  # UTM Medium
-        "new_utm_term": lead.get("new_utm_term" ),  # UTM Term
-        "new_utm_keyword": lead.get("new_utm_keyword" ),  # UTM Keyword
-        "Created On": lead.get("createdon" ),  # Created date
-        # "Owner": lead.get("_ownerid_value"),  # Owner ID
-        "Owner": internal_email_address,
-        "Topic": lead.get("subject"),  
-        "Parent Contact Email": parent_contact_email,  # Parent contact email
-        "Parent Account Number": parent_account_number  # Parent account number
-        # "Parent Contact for lead": lead.get("_parentcontactid_value"),  
-        # "Parent Account for lead": lead.get("_parentaccountid_value"),  
-
-    }
-
-    print("caling meta data for other attributes")
-    
-    customer_id=payload.get("u_em")
-    final_payload={
-        "type": "transition",
-        "elements": [
-            {
-                "type": "customer",
-                "customer_id": customer_id,
-                "attributes": payload,
-            },
-            {
-                "type": "event",
-                "customer_id": customer_id,
-                "device_id": "96bd03b6-defc-4203-83d3-dc1c73080232",  # Replace with actual device ID if available
-                "actions": []  # Empty actions array as per your example
-            },
-        ],
-    }
-    print(final_payload)
-    
-    return final_payload
 
+async def map_lead_to_moengage(lead):
+    # Owners are resolved per page by resolve_owner_emails before mapping
+    return LEAD_MAPPING.map_record(lead, await lead_option_labels())
 
 
 async def send_to_moengage(leads):
-    success_count=0
-    failed_count=0
-    
     headers = {
-        'Authorization':token_moe ,
+        'Authorization': f"Basic {get_setting('moe_token')}",
         'Content-Type': 'application/json',
         'MOE-APPKEY':'6978DCU8W19J0XQOKS7NEE1C_DEBUG'
     }
 
-    for lead in leads:
-        payload = await map_lead_to_moengage(lead)
-        response = requests.post(MOENGAGE_API_URL, json=payload, headers=headers)
-        if response.status_code == 200:
-            success_count+=1
-            print(f"Lead {lead['emailaddress1']} sent successfully")
-        else:
-            failed_count+=1
-            print(f"Failed to send lead {lead['emailaddress1']}: {response.text}")
-
-    
-    log_processedRecords(S3_BUCKET_NAME,success_count,failed_count)
+    # Load every option set the mapper needs in one step instead of three calls per lead
+    await warm_option_sets("lead", LEAD_OPTION_SETS)
+    await resolve_owner_emails(leads)
 
+    labels = await lead_option_labels()
+    return await push_records(
+        leads, map_lead_to_moengage, get_setting("MOENGAGE_API_URL"), headers, label="lead",
+        page_mapper=lambda page: LEAD_MAPPING.map_page(page, labels),
+    )
 
 
 # Endpoint to fetch and send leads to MoEngage
 @router.get("/sync-leads")
-async def sync_leads():
+@single_flight("leads")
+@track_sync("leads")
+async def sync_leads(shards: int = Query(CRM_FETCH_SHARDS, ge=1, le=32, description="Time slices fetched in parallel; 1 pages the window sequentially")):
     try:
-        leads_response = await fetch_leads()
-        leads = leads_response.get("leads", [])
+        # Send each page to MoEngage while the next one is being downloaded
+        counts = await sync_window("leads", iter_lead_pages, send_to_moengage, "createdon", shards, fields=LEAD_MAPPING.columns)
 
-        # Send leads to MoEngage
-        await send_to_moengage(leads)
+        log_processed_records("leads", counts["success"], counts["failed"])
 
-
-        return {"status": "Leads synchronized successfully"}
+        return {"status": "Leads synchronized successfully", "success": counts["success"], "failed": counts["failed"]}
 
     except Exception as e:
         error_message = f"Error during sync-leads: {str(e)}"
-        log_error(S3_BUCKET_NAME, error_message)
+        log_error(error_message)
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
     
 
@@ -320,21 +127,18 @@ async def sync_leads():
 
 async def fetch_metadata(attribute: str = Query("new_leadtype", description="Logical name of the attribute to fetch metadata for")):
     
-    global global_token
-
-
-    token = global_token
+    token = await authenticate_crm()
     headers = {
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json",
     }
 
     # URL template with the required query expansion for detailed attribute metadata
-    metadata_url = f"{CRM_API_URL}/api/data/v9.0/EntityDefinitions(LogicalName='lead')/Attributes(LogicalName='{attribute}')/Microsoft.Dynamics.CRM.PicklistAttributeMetadata?$expand=OptionSet"
+    metadata_url = f"{get_setting('CRM_API_URL')}/api/data/v9.0/EntityDefinitions(LogicalName='lead')/Attributes(LogicalName='{attribute}')/Microsoft.Dynamics.CRM.PicklistAttributeMetadata?$expand=OptionSet"
 
     try:
         # Fetch metadata
-        response = httpx.get(metadata_url, headers=headers)
+        response = await batched_get(metadata_url, headers)
         response.raise_for_status()
 
         # Extract and return relevant parts of the response
@@ -363,20 +167,17 @@ async def fetch_metadata(attribute: str = Query("new_leadtype", description="Log
 async def fetch_statuscode_metadata(attribute: str = Query("statuscode", description="Logical name of the attribute to fetch metadata for")):
    
 
-    global global_token
-
-
-    token = global_token
+    token = await authenticate_crm()
     headers = {
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json",
     }
 
-    metadata_url = f"{CRM_API_URL}/api/data/v9.2/EntityDefinitions(LogicalName='lead')/Attributes(LogicalName='{attribute}')/Microsoft.Dynamics.CRM.StatusAttributeMetadata?$expand=OptionSet"
+    metadata_url = f"{get_setting('CRM_API_URL')}/api/data/v9.0/EntityDefinitions(LogicalName='lead')/Attributes(LogicalName='{attribute}')/Microsoft.Dynamics.CRM.StatusAttributeMetadata?$expand=OptionSet"
 
     try:
         # Fetch metadata
-        response = httpx.get(metadata_url, headers=headers)
+        response = await batched_get(metadata_url, headers)
         response.raise_for_status()
 
         # Extract and return relevant parts of the response
@@ -412,22 +213,17 @@ async def fetch_leadsourcecode_metadata(attribute: str = Query("leadsourcecode",
    
 
 
-    global global_token
-
-
-    token = global_token
-
-
+    token = await authenticate_crm()
     headers = {
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json",
     }
 
-    metadata_url = f"{CRM_API_URL}/api/data/v9.0/EntityDefinitions(LogicalName='lead')/Attributes(LogicalName='{attribute}')/Microsoft.Dynamics.CRM.PicklistAttributeMetadata?$expand=OptionSet"
+    metadata_url = f"{get_setting('CRM_API_URL')}/api/data/v9.0/EntityDefinitions(LogicalName='lead')/Attributes(LogicalName='{attribute}')/Microsoft.Dynamics.CRM.PicklistAttributeMetadata?$expand=OptionSet"
 
     try:
         # Fetch metadata
-        response = httpx.get(metadata_url, headers=headers)
+        response = await batched_get(metadata_url, headers)
         response.raise_for_status()
 
         # Extract and return relevant parts of the response
@@ -455,63 +251,58 @@ async def fetch_leadsourcecode_metadata(attribute: str = Query("leadsourcecode",
 
 
 
-async def fetch_email_from_lead():
+# Option sets used by map_lead_to_moengage, keyed by attribute logical name
+LEAD_OPTION_SETS = {
+    "new_leadtype": fetch_metadata,
+    "statuscode": fetch_statuscode_metadata,
+    "leadsourcecode": fetch_leadsourcecode_metadata,
+}
 
-    global global_token
-    try:
-        # Get the token dynamically
-        token = global_token
-        
-        # Headers with the dynamic token
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
 
-        # Step 1: Fetch _ownerid_value from the Leads API
-        leads_url = (
-            f"{CRM_API_URL}/api/data/v9.0/leads"
-            "?$select=_ownerid_value"
-            "&$orderby=createdon desc"
-        )
-        leads_response = requests.get(leads_url, headers=headers)
-        # print("Leads Response:", leads_response.status_code, leads_response.text)  
-        leads_response.raise_for_status()
-        
-        leads_data = leads_response.json()
-        if not leads_data.get("value"):
-            raise HTTPException(status_code=404, detail="No leads found.")
-        
-        # Get the first _ownerid_value
-        _ownerid_value = leads_data["value"][0].get("_ownerid_value")
-        if not _ownerid_value:
-            raise HTTPException(status_code=404, detail="_ownerid_value not found in the lead.")
-
-
-        system_user_url = (
-            f"{CRM_API_URL}/api/data/v9.0/systemusers"
-            f"?$filter=systemuserid eq {_ownerid_value}"
-            "&$select=internalemailaddress,fullname"
-        )
-        system_user_response = requests.get(system_user_url, headers=headers)
-        # print("System User Response:", system_user_response.status_code, system_user_response.text) 
-        system_user_response.raise_for_status()
-
-        system_user_data = system_user_response.json()
-        if not system_user_data.get("value"):
-            raise HTTPException(status_code=404, detail="No system user found with the given _ownerid_value.")
-
-        # Extract the email address
-        internal_email_address = system_user_data["value"][0].get("internalemailaddress")
-       
-        if not internal_email_address:
-            raise HTTPException(status_code=404, detail="Internal email address not found.")
+# systemuserid values per systemusers query, keeps the $filter well under URL length limits
+OWNER_LOOKUP_CHUNK_SIZE = 50
 
-        return {
-        
-            "internal_email_address": internal_email_address,
-        }
 
-    except requests.RequestException as e:
-        print("Error:", str(e))  # Debugging line
+async def resolve_owner_emails(leads):
+    """Resolve the owner emails of a page of leads into the owner index in bulk."""
+
+    missing = missing_owner_ids(lead.get("_ownerid_value") for lead in leads)
+    if not missing:
+        return
+
+    headers = {
+        "Authorization": f"Bearer {await authenticate_crm()}",
+        "Content-Type": "application/json"
+    }
+
+    chunks = [missing[start:start + OWNER_LOOKUP_CHUNK_SIZE] for start in range(0, len(missing), OWNER_LOOKUP_CHUNK_SIZE)]
+    try:
+        # The chunk queries are independent, so they go out together in one $batch
+        system_user_urls = []
+        for chunk in chunks:
+            owner_filter = " or ".join(f"systemuserid eq {owner_id}" for owner_id in chunk)
+            system_user_urls.append(
+                f"{get_setting('CRM_API_URL')}/api/data/v9.0/systemusers"
+                f"?$filter={owner_filter}"
+                "&$select=systemuserid,internalemailaddress"
+            )
+        with timed("lookup"):
+            system_user_responses = await asyncio.gather(*(batched_get(url, headers) for url in system_user_urls))
+
+        for chunk, system_user_response in zip(chunks, system_user_responses):
+            system_user_response.raise_for_status()
+
+            found = {
+                user.get("systemuserid"): user.get("internalemailaddress")
+                for user in system_user_response.json().get("value", [])
+            }
+            # Owners that are teams or deleted users have no systemusers row; cache them as None
+            for owner_id in chunk:
+                remember_owner_email(owner_id, found.get(owner_id))
+
+        print(f"Resolved {len(missing)} lead owner(s)")
+
+    except httpx.HTTPError as e:
+        error_message = f"Error resolving lead owner emails: {str(e)}"
+        log_error(error_message)
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,242 @@
+import asyncio
+import functools
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from datetime import datetime, timezone
+from fastapi import HTTPException
+from sourcecode.metrics import inc_counter
+from sourcecode.sharedTask import start_shared_task
+
+
+# Lock shared with other processes: "memory" (this process only), "sqlite" (processes on
+# this host sharing RUN_LOCK_DB_PATH) or "dynamodb" (every container, via a conditional write)
+RUN_LOCK_BACKEND = os.getenv("RUN_LOCK_BACKEND", "memory")
+RUN_LOCK_DB_PATH = os.getenv("RUN_LOCK_DB_PATH", "/tmp/afi_run_locks.sqlite")
+RUN_LOCK_TABLE = os.getenv("RUN_LOCK_TABLE", "afi-run-locks")
+# DynamoDB Local or another stand-in, e.g. http://localhost:8000
+RUN_LOCK_DYNAMODB_ENDPOINT = os.getenv("RUN_LOCK_DYNAMODB_ENDPOINT", "")
+
+# A lock whose holder died is taken over after this long; Lambda invocations end within 15 minutes
+RUN_LOCK_TTL_SECONDS = int(os.getenv("RUN_LOCK_TTL_SECONDS", "900"))
+
+# What a sync trigger does while the same entity is already syncing in this process:
+# "join" waits for the running sync and returns its result, "status" returns at once
+RUN_LOCK_OVERLAP = os.getenv("RUN_LOCK_OVERLAP", "join")
+
+# entity -> {"task": running sync, "owner": lock owner, "started_at": ISO timestamp}
+_running = {}
+
+
+def _holder(entity: str, owner: str, started_at: str, expires_at: float):
+    return {"entity": entity, "owner": owner, "started_at": started_at, "expires_at": expires_at}
+
+
+class MemoryRunLock:
+    """Run lock visible to this process only; overlapping triggers in it are joined anyway."""
+
+    def __init__(self):
+        self._holders = {}
+
+    def acquire(self, entity: str, owner: str, started_at: str, ttl: int):
+        holder = self._holders.get(entity)
+        if holder is not None and holder["expires_at"] > time.time():
+            return holder
+        self._holders[entity] = _holder(entity, owner, started_at, time.time() + ttl)
+        return None
+
+    def release(self, entity: str, owner: str):
+        if self._holders.get(entity, {}).get("owner") == owner:
+            del self._holders[entity]
+
+
+class SqliteRunLock:
+    """Run lock in a local SQLite file, shared by the processes of one host (e.g. uvicorn workers)."""
+
+    def __init__(self, path: str = None):
+        self.path = path or RUN_LOCK_DB_PATH
+
+    def _connect(self):
+        # Autocommit mode so BEGIN IMMEDIATE controls the write lock explicitly
+        connection = sqlite3.connect(self.path, isolation_level=None, timeout=10)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS run_locks ("
+            "entity TEXT PRIMARY KEY, owner TEXT NOT NULL, started_at TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        return connection
+
+    def acquire(self, entity: str, owner: str, started_at: str, ttl: int):
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT owner, started_at, expires_at FROM run_locks WHERE entity = ?", (entity,)
+            ).fetchone()
+            if row is not None and row[2] > time.time():
+                connection.execute("ROLLBACK")
+                return _holder(entity, *row)
+            connection.execute(
+                "INSERT OR REPLACE INTO run_locks (entity, owner, started_at, expires_at) VALUES (?, ?, ?, ?)",
+                (entity, owner, started_at, time.time() + ttl),
+            )
+            connection.execute("COMMIT")
+            return None
+        finally:
+            connection.close()
+
+    def release(self, entity: str, owner: str):
+        connection = self._connect()
+        try:
+            connection.execute("DELETE FROM run_locks WHERE entity = ? AND owner = ?", (entity, owner))
+        finally:
+            connection.close()
+
+
+class DynamoDbRunLock:
+    """Run lock taken with a conditional ``PutItem``, shared by every container of the service.
+
+    The table needs a string partition key named ``entity``. Point ``RUN_LOCK_DYNAMODB_ENDPOINT``
+    at DynamoDB Local to run it without AWS.
+    """
+
+    def __init__(self, table: str = None, endpoint_url: str = None):
+        import boto3
+        self.table = table or RUN_LOCK_TABLE
+        endpoint_url = endpoint_url or RUN_LOCK_DYNAMODB_ENDPOINT
+        self.client = boto3.client("dynamodb", **({"endpoint_url": endpoint_url} if endpoint_url else {}))
+
+    def acquire(self, entity: str, owner: str, started_at: str, ttl: int, attempts: int = 3):
+        for _ in range(attempts):
+            holder = self._try_acquire(entity, owner, started_at, ttl)
+            # No holder to report means the lock was released between the write and the read
+            if holder != {}:
+                return holder
+        return _holder(entity, "unknown", started_at, time.time())
+
+    def _try_acquire(self, entity: str, owner: str, started_at: str, ttl: int):
+        now = time.time()
+        try:
+            self.client.put_item(
+                TableName=self.table,
+                Item={
+                    "entity": {"S": entity},
+                    "owner": {"S": owner},
+                    "started_at": {"S": started_at},
+                    "expires_at": {"N": str(now + ttl)},
+                },
+                # OWNER is a DynamoDB reserved word, so attributes are always referenced by name
+                ConditionExpression="attribute_not_exists(#entity) OR #expires_at < :now",
+                ExpressionAttributeNames={"#entity": "entity", "#expires_at": "expires_at"},
+                ExpressionAttributeValues={":now": {"N": str(now)}},
+            )
+            return None
+        except self.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+        item = self.client.get_item(TableName=self.table, Key={"entity": {"S": entity}}, ConsistentRead=True).get("Item")
+        if item is None:
+            return {}
+        return _holder(entity, item["owner"]["S"], item["started_at"]["S"], float(item["expires_at"]["N"]))
+
+    def release(self, entity: str, owner: str):
+        try:
+            self.client.delete_item(
+                TableName=self.table,
+                Key={"entity": {"S": entity}},
+                ConditionExpression="#owner = :owner",
+                ExpressionAttributeNames={"#owner": "owner"},
+                ExpressionAttributeValues={":owner": {"S": owner}},
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            # The lease expired and another run took the lock over; it is not ours to delete
+            pass
+
+
+_BACKENDS = {
+    "memory": MemoryRunLock,
+    "sqlite": SqliteRunLock,
+    "dynamodb": DynamoDbRunLock,
+}
+
+_backend = None
+
+
+def get_run_lock():
+    """The process-wide run lock backend selected by ``RUN_LOCK_BACKEND``."""
+    global _backend
+    if _backend is None:
+        backend = _BACKENDS.get(RUN_LOCK_BACKEND)
+        if backend is None:
+            raise ValueError(f"Unknown RUN_LOCK_BACKEND '{RUN_LOCK_BACKEND}'")
+        _backend = backend()
+    return _backend
+
+
+def _already_running(label: str, holder: dict):
+    return {
+        "status": f"{label} sync already running",
+        "owner": holder["owner"],
+        "started_at": holder["started_at"],
+    }
+
+
+async def _run_exclusive(entity: str, label: str, owner: str, started_at: str, func, args, kwargs):
+    try:
+        lock = get_run_lock()
+        holder = await asyncio.to_thread(lock.acquire, entity, owner, started_at, RUN_LOCK_TTL_SECONDS)
+    except Exception as e:
+        # Without the lock a second run could push the same records, so do not sync at all
+        print(f"Failed to take the {entity} run lock: {e}")
+        raise HTTPException(status_code=503, detail=f"{label} run lock unavailable: {str(e)}")
+    if holder is not None:
+        inc_counter("afi_sync_triggers_total", entity=entity, outcome="skipped")
+        print(f"{label} sync already running on {holder['owner']} since {holder['started_at']}, skipping")
+        return _already_running(label, holder)
+    inc_counter("afi_sync_triggers_total", entity=entity, outcome="started")
+    try:
+        return await func(*args, **kwargs)
+    finally:
+        try:
+            await asyncio.to_thread(lock.release, entity, owner)
+        except Exception as e:
+            # The lease expires on its own, so a failed release only delays the next run
+            print(f"Failed to release the {entity} run lock: {e}")
+
+
+def _finished(entity: str, task):
+    _running.pop(entity, None)
+
+
+def single_flight(entity: str):
+    """Decorator for sync endpoints: at most one run per entity at a time.
+
+    A trigger that arrives while this process is already syncing the entity joins that run
+    and returns its result (or, with ``RUN_LOCK_OVERLAP=status``, returns its status at
+    once). When another process holds the entity's lock, the trigger returns the holder's
+    status without syncing. The first trigger's arguments decide what the run does.
+    """
+    label = entity.capitalize()
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            running = _running.get(entity)
+            if running is None:
+                owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+                started_at = datetime.now(timezone.utc).isoformat()
+                task = start_shared_task(_run_exclusive(entity, label, owner, started_at, func, args, kwargs))
+                _running[entity] = {"task": task, "owner": owner, "started_at": started_at}
+                task.add_done_callback(functools.partial(_finished, entity))
+                # Shielded so a disconnecting caller does not cancel the run for those who joined it
+                return await asyncio.shield(task)
+
+            if RUN_LOCK_OVERLAP == "status":
+                inc_counter("afi_sync_triggers_total", entity=entity, outcome="skipped")
+                return _already_running(label, running)
+            inc_counter("afi_sync_triggers_total", entity=entity, outcome="joined")
+            print(f"{label} sync already running since {running['started_at']}, waiting for it")
+            return await asyncio.shield(running["task"])
+        return wrapper
+    return decorator
@@ -0,0 +1,17 @@
+import asyncio
+
+
+def _retrieve_exception(task):
+    if not task.cancelled():
+        task.exception()
+
+
+def start_shared_task(coroutine):
+    """Run ``coroutine`` as a task that any number of callers may await, including none.
+
+    The task's exception is retrieved when it finishes, so a failure whose callers all went
+    away is not reported as "exception was never retrieved".
+    """
+    task = asyncio.ensure_future(coroutine)
+    task.add_done_callback(_retrieve_exception)
+    return task
@@ -0,0 +1,53 @@
+import sys
+import time
+from contextlib import contextmanager
+
+
+# Recorded cold-start phases in the order they ran
+_phases = []
+_process_started = time.perf_counter()
+
+
+@contextmanager
+def measure(name: str, kind: str = "import", record: bool = True):
+    """Time one cold-start phase and record how many modules it pulled in.
+
+    ``kind`` is "import" for module imports and "init" for client construction and
+    network warm-up. ``record=False`` runs the block without recording it, for startup
+    work repeated after the cold start. For a per-module breakdown of a single import, run
+    the app under ``python -X importtime``.
+    """
+    if not record:
+        yield
+        return
+    modules_before = len(sys.modules)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append({
+            "name": name,
+            "kind": kind,
+            "seconds": round(time.perf_counter() - started, 4),
+            "modules_loaded": len(sys.modules) - modules_before,
+        })
+
+
+def startup_report():
+    """Return the recorded phases with per-kind and overall totals."""
+    totals = {}
+    for phase in _phases:
+        totals[phase["kind"]] = round(totals.get(phase["kind"], 0.0) + phase["seconds"], 4)
+    return {
+        "phases": list(_phases),
+        "totals": totals,
+        "since_process_start_seconds": round(time.perf_counter() - _process_started, 4),
+    }
+
+
+def print_startup_report():
+    """Print the cold-start breakdown, slowest phases first, to the Lambda log."""
+    report = startup_report()
+    print(f"Startup report: {report['totals']}")
+    for phase in sorted(report["phases"], key=lambda phase: phase["seconds"], reverse=True):
+        print(f"  {phase['kind']:<6} {phase['name']:<40} {phase['seconds']:.4f}s ({phase['modules_loaded']} modules)")
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import os
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+
+# Local SQLite checkpoint database, used unless an S3 bucket is configured
+CHECKPOINT_DB_PATH = os.getenv("CHECKPOINT_DB_PATH", "/tmp/afi_sync_checkpoints.sqlite")
+CHECKPOINT_S3_BUCKET = os.getenv("CHECKPOINT_S3_BUCKET", "")
+CHECKPOINT_S3_PREFIX = os.getenv("CHECKPOINT_S3_PREFIX", "checkpoints/")
+
+# Re-read this much before the stored watermark to pick up records committed late
+SYNC_WATERMARK_OVERLAP_SECONDS = int(os.getenv("SYNC_WATERMARK_OVERLAP_SECONDS", "300"))
+
+# Window used when an entity has no watermark yet
+SYNC_DEFAULT_LOOKBACK_HOURS = int(os.getenv("SYNC_DEFAULT_LOOKBACK_HOURS", "1"))
+
+
+def _sqlite_connect():
+    connection = sqlite3.connect(CHECKPOINT_DB_PATH)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS checkpoints (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at TEXT NOT NULL)"
+    )
+    return connection
+
+
+def _sqlite_load(key: str):
+    with _sqlite_connect() as connection:
+        row = connection.execute("SELECT value FROM checkpoints WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _sqlite_save(key: str, value: str):
+    with _sqlite_connect() as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO checkpoints (key, value, updated_at) VALUES (?, ?, ?)",
+            (key, value, datetime.now(timezone.utc).isoformat()),
+        )
+
+
+def _s3_load(key: str):
+    import boto3
+    s3 = boto3.client("s3")
+    try:
+        response = s3.get_object(Bucket=CHECKPOINT_S3_BUCKET, Key=f"{CHECKPOINT_S3_PREFIX}{key}.json")
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(response["Body"].read())["value"]
+
+
+def _s3_save(key: str, value: str):
+    import boto3
+    s3 = boto3.client("s3")
+    s3.put_object(
+        Bucket=CHECKPOINT_S3_BUCKET,
+        Key=f"{CHECKPOINT_S3_PREFIX}{key}.json",
+        Body=json.dumps({"value": value, "updated_at": datetime.now(timezone.utc).isoformat()}),
+    )
+
+
+async def load_checkpoint(key: str):
+    """Return the stored checkpoint value for a key, or None if there is none."""
+    loader = _s3_load if CHECKPOINT_S3_BUCKET else _sqlite_load
+    return await asyncio.to_thread(loader, key)
+
+
+async def save_checkpoint(key: str, value: str):
+    """Store a checkpoint value for a key, replacing any previous value."""
+    saver = _s3_save if CHECKPOINT_S3_BUCKET else _sqlite_save
+    await asyncio.to_thread(saver, key, value)
+
+
+def format_odata_datetime(moment: datetime):
+    """Format a UTC datetime the way the CRM filters expect it."""
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def parse_odata_datetime(value: str):
+    """Parse an OData datetime string back into a naive UTC datetime."""
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
+
+
+async def load_watermark(entity: str):
+    """Return the OData datetime a sync of ``entity`` should start from.
+
+    This is the last checkpointed watermark minus a small overlap, or the default look-back
+    window when the entity has never been synced.
+    """
+    watermark = await load_checkpoint(f"watermark:{entity}")
+    if watermark is None:
+        return format_odata_datetime(datetime.utcnow() - timedelta(hours=SYNC_DEFAULT_LOOKBACK_HOURS))
+    since = parse_odata_datetime(watermark) - timedelta(seconds=SYNC_WATERMARK_OVERLAP_SECONDS)
+    return format_odata_datetime(since)
+
+
+async def save_watermark(entity: str, watermark: str):
+    """Checkpoint the highest timestamp of ``entity`` that has been pushed successfully."""
+    await save_checkpoint(f"watermark:{entity}", watermark)
+
+
+def safe_watermark(records, failed_records, field: str):
+    """Return ``(watermark, blocked)`` for a page of records sorted ascending by ``field``.
+
+    The watermark is the highest timestamp that has no failed record at or before it, so a
+    resumed run never skips a record that was not delivered. ``blocked`` is True when the
+    page had failures, meaning later pages must not advance the watermark in this run.
+    """
+    if failed_records:
+        earliest_failed = min(record.get(field) or "" for record in failed_records)
+        delivered = [record[field] for record in records if record.get(field) and record[field] < earliest_failed]
+    else:
+        delivered = [record[field] for record in records if record.get(field)]
+    return (max(delivered) if delivered else None), bool(failed_records)